@@ -0,0 +1,286 @@
+#!/usr/bin/env python
+
+"""
+This script benchmarks the archive, decoding and scaling code of Comix.
+It does not open any windows, so it can be run without a display.
+-------------------------------------------------------------------------------
+Usage: benchmark.py [OPTIONS]
+
+Options:
+    --pages <n>              Number of pages in the generated archives
+                             (default 20).
+
+    --size <width>x<height>  Resolution of the generated pages
+                             (default 1600x2400).
+
+    --repeat <n>             Number of times to run each benchmark
+                             (default 3).
+
+    --threads <n>            Number of extraction threads (default 1).
+
+    --output <file>          Write the results to <file> instead of to
+                             standard output.
+
+Synthetic .cbz and .cbt archives are always generated. A .cbr archive is
+generated if the "rar" program is installed, and a .cb7 archive if the
+"7z" or "7za" program is installed.
+
+The results are written as JSON. For every benchmark the minimum, median
+and maximum time in seconds over all runs is given.
+"""
+
+import os
+import sys
+import getopt
+import gettext
+import platform
+import random
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+import zipfile
+
+try:
+    import json
+except ImportError:
+    import simplejson as json
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)),
+    'src'))
+gettext.install('comix', unicode=True)
+
+import gtk
+from PIL import Image
+
+import archive
+import filehandler
+import histogram
+import image
+import thumbnail
+
+pages = 20
+width = 1600
+height = 2400
+repeat = 3
+threads = 1
+output = None
+
+
+def info():
+    """Print usage info and exit."""
+    print __doc__
+    sys.exit(1)
+
+
+def time_function(func, *args):
+    """Run <func> with <args> <repeat> times and return a dictionary with
+    the minimum, median and maximum time in seconds.
+    """
+    times = []
+    for i in xrange(repeat):
+        start = time.time()
+        func(*args)
+        times.append(time.time() - start)
+    times.sort()
+    return {'min': times[0], 'median': times[len(times) // 2],
+        'max': times[-1], 'runs': len(times)}
+
+
+def make_page(path, number):
+    """Write a JPEG image with some texture to <path>."""
+    random.seed(number)
+    noise = ''.join([chr(random.randint(0, 255))
+        for i in xrange((width // 16) * (height // 16) * 3)])
+    try:
+        im = Image.frombytes('RGB', (width // 16, height // 16), noise)
+    except AttributeError:
+        im = Image.fromstring('RGB', (width // 16, height // 16), noise)
+    im = im.resize((width, height), Image.BILINEAR)
+    im.save(path, 'JPEG', quality=90)
+
+
+def make_fixtures(fixture_dir):
+    """Generate the pages and the archives in <fixture_dir>. Return a tuple
+    (page paths, dictionary of archive type names to archive paths).
+    """
+    page_dir = os.path.join(fixture_dir, 'pages')
+    os.mkdir(page_dir)
+    page_names = ['page%03d.jpg' % i for i in xrange(1, pages + 1)]
+    for i, name in enumerate(page_names):
+        make_page(os.path.join(page_dir, name), i)
+    archives = {}
+
+    path = os.path.join(fixture_dir, 'test.cbz')
+    zfile = zipfile.ZipFile(path, 'w', zipfile.ZIP_DEFLATED)
+    for name in page_names:
+        zfile.write(os.path.join(page_dir, name), name)
+    zfile.close()
+    archives['cbz'] = path
+
+    path = os.path.join(fixture_dir, 'test.cbt')
+    tfile = tarfile.open(path, 'w')
+    for name in page_names:
+        tfile.add(os.path.join(page_dir, name), name)
+    tfile.close()
+    archives['cbt'] = path
+
+    path = os.path.join(fixture_dir, 'test.cbr')
+    if run_program(['rar', 'a', '-inul', path] + page_names, page_dir):
+        archives['cbr'] = path
+
+    path = os.path.join(fixture_dir, 'test.cb7')
+    for program in ('7z', '7za'):
+        if run_program([program, 'a', path] + page_names, page_dir):
+            archives['cb7'] = path
+            break
+
+    return [os.path.join(page_dir, name) for name in page_names], archives
+
+
+def run_program(args, cwd):
+    """Run the program with <args> in the directory <cwd>. Return True if
+    it exited successfully.
+    """
+    try:
+        proc = subprocess.Popen(args, cwd=cwd, stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT)
+    except OSError:
+        return False
+    proc.communicate()
+    return proc.returncode == 0
+
+
+def setup_extractor(path):
+    """Read the file list of the archive at <path>."""
+    extractor = archive.Extractor()
+    extractor.setup(path, None)
+    extractor.close()
+
+
+def extract_archive(path):
+    """Extract all files of the archive at <path> to a temporary directory
+    and wait for the extraction to finish.
+    """
+    dst = tempfile.mkdtemp(prefix='comix-benchmark.')
+    try:
+        extractor = archive.Extractor()
+        condition = extractor.setup(path, dst)
+        files = extractor.get_files()
+        extractor.set_files(files)
+        extractor.extract(threads)
+        condition.acquire()
+        for name in files:
+            while not extractor.is_ready(name):
+                condition.wait()
+        condition.release()
+        extractor.stop()
+    finally:
+        shutil.rmtree(dst, True)
+
+
+def sort_names(names):
+    """Sort a copy of <names> alphanumerically."""
+    filehandler.alphanumeric_sort(names[:])
+
+
+def get_new_thumbnail(path):
+    """Create a thumbnail for <path> in an empty thumbnail directory."""
+    dst = tempfile.mkdtemp(prefix='comix-benchmark.')
+    try:
+        thumbnail.get_thumbnail(path, True, dst)
+    finally:
+        shutil.rmtree(dst, True)
+
+
+def run_benchmarks(page_paths, archives):
+    """Run all benchmarks and return a dictionary with the results."""
+    results = {}
+    for name, path in archives.items():
+        results['Extractor.setup (%s)' % name] = time_function(
+            setup_extractor, path)
+        results['Extractor.extract (%s)' % name] = time_function(
+            extract_archive, path)
+        results['get_archive_info (%s)' % name] = time_function(
+            archive.get_archive_info, path)
+        results['get_thumbnail (%s)' % name] = time_function(
+            get_new_thumbnail, path)
+
+    names = ['Chapter %d/Page %d.jpg' % (i // 100, i % 100)
+        for i in xrange(10000)]
+    random.seed(0)
+    random.shuffle(names)
+    results['alphanumeric_sort (10000 names)'] = time_function(sort_names,
+        names)
+
+    pixbuf = gtk.gdk.pixbuf_new_from_file(page_paths[0])
+    pixbuf2 = gtk.gdk.pixbuf_new_from_file(page_paths[-1])
+    results['decode page'] = time_function(gtk.gdk.pixbuf_new_from_file,
+        page_paths[0])
+    results['fit_in_rectangle'] = time_function(image.fit_in_rectangle,
+        pixbuf, 1280, 1024)
+    results['fit_2_in_rectangle'] = time_function(image.fit_2_in_rectangle,
+        pixbuf, pixbuf2, 1280, 1024)
+    scaled = image.fit_in_rectangle(pixbuf, 1280, 1024)
+    results['enhance'] = time_function(image.enhance, scaled, 1.1, 1.2,
+        1.1, 1.5)
+    results['get_most_common_edge_colour'] = time_function(
+        image.get_most_common_edge_colour, scaled)
+    results['draw_histogram'] = time_function(histogram.draw_histogram,
+        scaled)
+    results['get_thumbnail (jpg)'] = time_function(get_new_thumbnail,
+        page_paths[0])
+    return results
+
+
+def main():
+    global pages, width, height, repeat, threads, output
+    try:
+        opts, args = getopt.gnu_getopt(sys.argv[1:], '',
+            ['pages=', 'size=', 'repeat=', 'threads=', 'output=', 'help'])
+        for opt, value in opts:
+            if opt == '--pages':
+                pages = int(value)
+            elif opt == '--size':
+                width, height = [int(n) for n in value.split('x')]
+            elif opt == '--repeat':
+                repeat = int(value)
+            elif opt == '--threads':
+                threads = int(value)
+            elif opt == '--output':
+                output = value
+            else:
+                info()
+    except (getopt.GetoptError, ValueError):
+        info()
+    if args or pages < 1 or width < 16 or height < 16 or repeat < 1:
+        info()
+
+    fixture_dir = tempfile.mkdtemp(prefix='comix-benchmark.')
+    try:
+        page_paths, archives = make_fixtures(fixture_dir)
+        results = run_benchmarks(page_paths, archives)
+    finally:
+        shutil.rmtree(fixture_dir, True)
+
+    report = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'gtk': '.'.join([str(n) for n in gtk.gtk_version]),
+        'pages': pages,
+        'size': [width, height],
+        'threads': threads,
+        'archives': sorted(archives.keys()),
+        'results': results}
+    if output is None:
+        print json.dumps(report, indent=2, sort_keys=True)
+    else:
+        fd = open(output, 'w')
+        json.dump(report, fd, indent=2, sort_keys=True)
+        fd.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -78,14 +78,20 @@ FILES = (('src/about.py', 'share/comix/src'),
          ('src/librarybackend.pyc', 'share/comix/src'),
          ('src/main.py', 'share/comix/src'),
          ('src/main.pyc', 'share/comix/src'),
+         ('src/pixbufcache.py', 'share/comix/src'),
+         ('src/pixbufcache.pyc', 'share/comix/src'),
          ('src/portability.py', 'share/comix/src'),
          ('src/portability.pyc', 'share/comix/src'),
          ('src/preferences.py', 'share/comix/src'),
          ('src/preferences.pyc', 'share/comix/src'),
          ('src/process.py', 'share/comix/src'),
          ('src/process.pyc', 'share/comix/src'),
+         ('src/profiler.py', 'share/comix/src'),
+         ('src/profiler.pyc', 'share/comix/src'),
          ('src/properties.py', 'share/comix/src'),
          ('src/properties.pyc', 'share/comix/src'),
+         ('src/rarreader.py', 'share/comix/src'),
+         ('src/rarreader.pyc', 'share/comix/src'),
          ('src/recent.py', 'share/comix/src'),
          ('src/recent.pyc', 'share/comix/src'),
          ('src/slideshow.py', 'share/comix/src'),
@@ -96,6 +102,8 @@ FILES = (('src/about.py', 'share/comix/src'),
          ('src/thumbbar.pyc', 'share/comix/src'),
          ('src/thumbnail.py', 'share/comix/src'),
          ('src/thumbnail.pyc', 'share/comix/src'),
+         ('src/thumbpack.py', 'share/comix/src'),
+         ('src/thumbpack.pyc', 'share/comix/src'),
          ('src/thumbremover.py', 'share/comix/src'),
          ('src/thumbremover.pyc', 'share/comix/src'),
          ('src/ui.py', 'share/comix/src'),
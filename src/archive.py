@@ -3,17 +3,19 @@
 import sys
 import os
 import re
+import struct
 try:
     import czipfile as zipfile
 except:
     import zipfile
 import tarfile
+import tempfile
 import threading
 
 import gtk
 
 import process
-import time
+import rarreader
 import urllib
 import traceback
 
@@ -22,8 +24,13 @@ P7ZIP = 5
 
 _rar_exec = None
 _7z_exec = None
+_7z_help = None
 _last_pass = ""
 
+# The number of files extracted by each 7z process from non-solid 7z
+# archives, which are extracted a few files at a time in queue order.
+_7Z_CHUNK_FILES = 8
+
 def hfs_hack(f):
     if sys.platform == 'darwin':
         if type(f) == unicode:
@@ -68,9 +75,15 @@ class Extractor:
         self._files = []
         self._extracted = {}
         self._stop = False
-        self._extract_thread = None
+        self._extract_threads = []
+        self._queue = []
+        self._zip_password = None
         self._condition = threading.Condition()
         self._rarpass = '-p-'
+        self._rar_index = None
+        self._rar_members = None
+        self._7z_solid = False
+        self._zip_lock = threading.Lock()
 	global _last_pass
 
         if self._type == ZIP:
@@ -96,14 +109,20 @@ class Extractor:
                 dialog.destroy()
                 if ret == gtk.RESPONSE_OK:
 			self._zfile.setpassword(text)
+			self._zip_password = text
 			_last_pass = text
             self._files = self._zfile.namelist()
         elif self._type in (TAR, GZIP, BZIP2):
             self._tfile = tarfile.open(src, 'r')
             self._files = self._tfile.getnames()
         elif self._type == RAR:
+            index = rarreader.read_index(src)
+            if index is not None:
+                self._rar_index = index
+                self._rar_members = dict([(m.name, m) for m in index])
             global _rar_exec
-            if _rar_exec is None:
+            if _rar_exec is None and (index is None or
+              [m for m in index if not m.is_seekable()]):
                 _rar_exec = _get_rar_exec()
                 if _rar_exec is None:
                     print '! Could not find RAR file extractor.'
@@ -116,14 +135,17 @@ class Extractor:
                     dialog.destroy()
                     return None
             need_pass = False
-            proc = process.Process([_rar_exec, 'l', '-p-', '--', src])
-            fd = proc.spawn()
-            for line in fd.readlines():
-                if line and line[0] in '*C' and (line.startswith('*') or line.startswith('CRC') or line.startswith('Checksum')):
-                    need_pass = True
-                    break
-            fd.close()
-            proc.wait()
+            if index is not None:
+                need_pass = bool([m for m in index if m.encrypted])
+            else:
+                proc = process.Process([_rar_exec, 'l', '-p-', '--', src])
+                fd = proc.spawn()
+                for line in fd.readlines():
+                    if line and line[0] in '*C' and (line.startswith('*') or line.startswith('CRC') or line.startswith('Checksum')):
+                        need_pass = True
+                        break
+                fd.close()
+                proc.wait()
             if need_pass:
                 print >> sys.stderr, "You need password for ", src
                 dialog = gtk.MessageDialog(None, 0, gtk.MESSAGE_QUESTION,
@@ -141,11 +163,16 @@ class Extractor:
                 if ret == gtk.RESPONSE_OK:
                     self._rarpass = '-p' + text
 		    _last_pass = text
-            proc = process.Process([_rar_exec, 'vb', self._rarpass, '--', src])
-            fd = proc.spawn()
-            self._files = [name.rstrip(os.linesep) for name in fd.readlines()]
-            fd.close()
-            proc.wait()
+            if index is not None:
+                self._files = [m.name for m in index]
+            else:
+                proc = process.Process([_rar_exec, 'vb', self._rarpass, '--',
+                    src])
+                fd = proc.spawn()
+                self._files = [name.rstrip(os.linesep)
+                    for name in fd.readlines()]
+                fd.close()
+                proc.wait()
         elif self._type == P7ZIP:
             global _7z_exec
             if _7z_exec is None:
@@ -167,6 +194,8 @@ class Extractor:
             for line in fd:
                 if line.startswith('Path = '):
                     self._files.append(line[7:-1])
+                elif line.startswith('Solid = +'):
+                    self._7z_solid = True
                 elif line.startswith('Encrypted = +'):
                     need_pass = True
                 elif line.endswith('Wrong password?\n'):
@@ -198,6 +227,8 @@ class Extractor:
                         for line in fd:
                             if line.startswith('Path = '):
                                 self._files.append(line[7:-1])
+                            elif line.startswith('Solid = +'):
+                                self._7z_solid = True
                         fd.close()
                         proc.wait()
         else:
@@ -232,53 +263,177 @@ class Extractor:
         else:
             self._files = files
 
+    def set_priority(self, files):
+        """Move those of the files in <files> that are still waiting to be
+        extracted to the front of the extraction queue, in the given order.
+        This can be called while the extraction is running, e.g. when the
+        user jumps to another page.
+
+        Note: This has no effect on gzip or bzip2 compressed tar archives
+        (see set_files()), or on RAR members and solid 7z archives that are
+        decompressed by an external program, since those are extracted in
+        archive order.
+        """
+        if self._type in (GZIP, BZIP2):
+            return
+        self._condition.acquire()
+        queued = set(self._queue)
+        front = [name for name in files if name in queued]
+        if front:
+            front_set = set(front)
+            self._queue = front + [name for name in self._queue
+                if name not in front_set]
+        self._condition.release()
+
     def is_ready(self, name):
         """Return True if the file <name> in the extractor's file list
         (as set by set_files()) is fully extracted.
         """
         return self._extracted.get(name, False)
 
+    def read_file(self, name):
+        """Return the contents of the file <name> in a ZIP archive as a
+        string, without extracting it to disk. Stored (uncompressed) members
+        are read directly at their offset in the archive file.
+        """
+        info = self._zfile.getinfo(name)
+        if info.compress_type == zipfile.ZIP_STORED and not info.flag_bits & 0x1:
+            return _read_stored_zip_member(self._src, info)
+        self._zip_lock.acquire()
+        try:
+            return self._zfile.read(name)
+        finally:
+            self._zip_lock.release()
+
+    def extract_file(self, name):
+        """Extract the file <name> right away, in the calling thread, unless
+        it has already been extracted. This is meant for files that were
+        not in the list given to set_files().
+        """
+        if not self._stop and not self.is_ready(name):
+            self._extract_file(name)
+
     def get_mime_type(self):
         """Return the mime type name of the extractor's current archive."""
         return self._type
 
     def stop(self):
         """Signal the extractor to stop extracting and kill the extracting
-        thread. Blocks until the extracting thread has terminated.
+        threads. Blocks until the extracting threads have terminated.
         """
         self._stop = True
         if self._setupped:
-            self._extract_thread.join()
+            for thread in self._extract_threads:
+                thread.join()
             self.setupped = False
+            self.close() # ZIP archives are kept open for read_file().
 
-    def extract(self):
-        """Start extracting the files in the file list one by one using a
-        new thread. Every time a new file is extracted a notify() will be
-        signalled on the Condition that was returned by setup().
+    def extract(self, threads=1):
+        """Start extracting the files in the file list using new threads.
+        Files in ZIP and (uncompressed) tar archives are independent, so
+        they are extracted by <threads> worker threads in parallel, each
+        taking the next file from the list in turn. Other formats are
+        extracted one by one by a single thread. Every time a new file is
+        extracted a notify() will be signalled on the Condition that was
+        returned by setup().
         """
-        self._extract_thread = threading.Thread(target=self._thread_extract)
-        self._extract_thread.setDaemon(False)
-        self._extract_thread.start()
+        self._queue = self._files[:]
+        if self._type in (ZIP, TAR):
+            target = self._thread_extract_worker
+        else:
+            threads = 1
+            target = self._thread_extract
+        self._extract_threads = []
+        for i in xrange(max(1, threads)):
+            thread = threading.Thread(target=target)
+            thread.setDaemon(False)
+            thread.start()
+            self._extract_threads.append(thread)
 
     def close(self):
         """Close any open file objects, need only be called manually if the
         extract() method isn't called.
         """
         if self._type == ZIP:
+            self._zip_lock.acquire()
             self._zfile.close()
+            self._zip_lock.release()
         elif self._type in (TAR, GZIP, BZIP2):
             self._tfile.close()
 
     def _thread_extract(self):
         """Extract the files in the file list one by one."""
-        for name in self._files:
-            self._extract_file(name)
-        self.close()
+        if self._rar_members is not None:
+            # Stored members are copied directly out of the archive first,
+            # everything else is decompressed by a single unrar process.
+            streamed = []
+            name = self._next_file()
+            while name is not None:
+                member = self._rar_members.get(name)
+                if member is not None and not member.is_seekable():
+                    streamed.append(name)
+                else:
+                    self._extract_file(name)
+                name = self._next_file()
+            if streamed:
+                self._extract_rar_stream(streamed)
+        elif self._type == P7ZIP:
+            self._extract_7z()
+        else:
+            name = self._next_file()
+            while name is not None:
+                self._extract_file(name)
+                name = self._next_file()
+        if self._type != ZIP:
+            self.close()
+
+    def _thread_extract_worker(self):
+        """Extract files from the file list until it is exhausted. Each
+        worker thread uses its own handle to the archive so that several
+        files can be read and decompressed at the same time.
+        """
+        if self._type == ZIP:
+            handle = zipfile.ZipFile(self._src, 'r')
+            if self._zip_password is not None:
+                handle.setpassword(self._zip_password)
+        else:
+            handle = tarfile.open(self._src, 'r')
+        while not self._stop:
+            name = self._next_file()
+            if name is None:
+                break
+            self._extract_file(name, handle)
+        handle.close()
+
+    def _next_file(self):
+        """Remove and return the next file to extract from the file list
+        queue, or return None if there are no more files.
+        """
+        self._condition.acquire()
+        try:
+            if self._queue:
+                return self._queue.pop(0)
+            return None
+        finally:
+            self._condition.release()
 
-    def _extract_file(self, name):
+    def _next_files(self, count):
+        """Remove and return up to <count> of the next files to extract
+        from the file list queue.
+        """
+        self._condition.acquire()
+        try:
+            names = self._queue[:count]
+            del self._queue[:count]
+            return names
+        finally:
+            self._condition.release()
+
+    def _extract_file(self, name, handle=None):
         """Extract the file named <name> to the destination directory,
         mark the file as "ready", then signal a notify() on the Condition
-        returned by setup().
+        returned by setup(). If <handle> is not None it is an open ZipFile
+        or TarFile for the archive that is used by the calling thread only.
         """
         if self._stop:
             self.close()
@@ -287,16 +442,55 @@ class Extractor:
             if self._type == ZIP:
                 dst_path = os.path.join(self._dst, hfs_hack(name))
                 if not os.path.exists(os.path.dirname(dst_path)):
-                    os.makedirs(os.path.dirname(dst_path))
+                    try:
+                        os.makedirs(os.path.dirname(dst_path))
+                    except OSError: # Created by another worker.
+                        pass
+                if handle is not None:
+                    data = handle.read(name)
+                else:
+                    self._zip_lock.acquire()
+                    try:
+                        data = self._zfile.read(name)
+                    finally:
+                        self._zip_lock.release()
                 new = open(dst_path, 'wb')
-                new.write(self._zfile.read(name))
+                new.write(data)
                 new.close()
             elif self._type in (TAR, GZIP, BZIP2):
                 if os.path.normpath(os.path.join(self._dst, name)).startswith(
                   self._dst):
-                    self._tfile.extract(name, self._dst)
+                    if handle is not None:
+                        dst_dir = os.path.dirname(os.path.join(self._dst,
+                            name))
+                        if not os.path.exists(dst_dir):
+                            try:
+                                os.makedirs(dst_dir)
+                            except OSError: # Created by another worker.
+                                pass
+                        # The member offsets found when the archive was
+                        # listed are valid for every handle to it.
+                        handle.extract(self._tfile.getmember(name),
+                            self._dst)
+                    else:
+                        self._tfile.extract(name, self._dst)
                 else:
                     print '! Non-local tar member:', name, '\n'
+            elif (self._type == RAR and
+              self._get_seekable_rar_member(name) is not None):
+                member = self._rar_members[name]
+                dst_path = os.path.join(self._dst, name)
+                if os.path.normpath(dst_path).startswith(self._dst):
+                    if not os.path.exists(os.path.dirname(dst_path)):
+                        os.makedirs(os.path.dirname(dst_path))
+                    src = open(self._src, 'rb')
+                    new = open(dst_path, 'wb')
+                    src.seek(member.offset)
+                    _copy_bytes(src, new, member.unpacked_size)
+                    new.close()
+                    src.close()
+                else:
+                    print '! Non-local RAR member:', name, '\n'
             elif self._type == RAR:
                 if _rar_exec is not None:
                     proc = process.Process([_rar_exec, 'x', '-kb', self._rarpass,
@@ -305,58 +499,6 @@ class Extractor:
                     proc.wait()
                 else:
                     print '! Could not find RAR file extractor.'
-            elif self._type == P7ZIP:
-                if self.is_ready(name):
-                    return
-                if _7z_exec is not None:
-                    need_bb = False
-                    proc = process.Process([_7z_exec, '-h'])
-                    fd = proc.spawn()
-                    for line in fd.readlines():
-                        if line.startswith('  -bb[0-3]'):
-                            need_bb = True
-                            break
-                    fd.close()
-                    proc.wait()
-                    if not need_bb:
-                        proc = process.Process([_7z_exec, 'x', self._rarpass,
-                            '-y', '-bd', '-o' + self._dst, self._src]) #, name
-                    else:
-                        proc = process.Process([_7z_exec, 'x', self._rarpass,
-                            '-y', '-bd', '-bb1', '-bse1', '-o' + self._dst, self._src]) #, name
-                    fd = proc.spawn()
-                    line = fd.readline()
-                    count = 0
-                    while line:
-                        if line.startswith('Extracting  '):
-                            self._condition.acquire()
-                            fname = line[12:-1]
-                            if fname.endswith('     Data Error in encrypted file. Wrong password?'):
-                                    fname = fname[:-50]
-                            self._extracted[fname] = True
-                            self._condition.notify()
-                            self._condition.release()
-                            if count == 10:
-                                count = 0
-                                time.sleep(0.1)
-                            else:
-                                count += 1
-                        elif line.startswith('- ') or line.startswith('T '):
-                            self._condition.acquire()
-                            fname = line[2:-1]
-                            self._extracted[fname] = True
-                            self._condition.notify()
-                            self._condition.release()
-                            if count == 10:
-                                count = 0
-                                time.sleep(0.1)
-                            else:
-                                count += 1
-                        line = fd.readline()
-                    proc.wait()
-                    return
-                else:
-                    print '! Could not find 7z file extractor.'
         except Exception:
             # Better to ignore any failed extractions (e.g. from a corrupt
             # archive) than to crash here and leave the main thread in a
@@ -369,6 +511,146 @@ class Extractor:
         self._condition.notify()
         self._condition.release()
 
+    def _get_seekable_rar_member(self, name):
+        """Return the RarMember for <name> if its data can be copied
+        straight out of the archive file, or None if it has to be
+        extracted by the unrar program (e.g. when it is compressed, solid
+        or encrypted, or when the archive index could not be read).
+        """
+        if self._rar_members is None:
+            return None
+        member = self._rar_members.get(name)
+        if member is None or not member.is_seekable():
+            return None
+        return member
+
+    def _extract_rar_stream(self, names):
+        """Extract the RAR members in <names> from the output of a single
+        "unrar p" process. It writes the contents of all the files in the
+        archive to stdout, in archive order, and the output is split back
+        into separate files using the unpacked sizes from the member index.
+        Members that could not be extracted are still marked as "ready".
+        """
+        wanted = dict.fromkeys(names)
+        proc = process.Process([_rar_exec, 'p', '-inul', self._rarpass, '--',
+            self._src], merge_stderr=False)
+        fd = proc.spawn()
+        if fd is not None:
+            try:
+                for member in self._rar_index:
+                    if not wanted or self._stop:
+                        break
+                    if member.name not in wanted:
+                        _copy_bytes(fd, None, member.unpacked_size)
+                        continue
+                    del wanted[member.name]
+                    dst_path = os.path.join(self._dst, member.name)
+                    if os.path.normpath(dst_path).startswith(self._dst):
+                        if not os.path.exists(os.path.dirname(dst_path)):
+                            os.makedirs(os.path.dirname(dst_path))
+                        new = open(dst_path, 'wb')
+                        _copy_bytes(fd, new, member.unpacked_size)
+                        new.close()
+                    else:
+                        print '! Non-local RAR member:', member.name, '\n'
+                        _copy_bytes(fd, None, member.unpacked_size)
+                    self._condition.acquire()
+                    self._extracted[member.name] = True
+                    self._condition.notify()
+                    self._condition.release()
+            except Exception:
+                traceback.print_exc()
+            # Closing the pipe early makes unrar exit on SIGPIPE.
+            fd.close()
+            proc.wait()
+        if self._stop:
+            self.close()
+            sys.exit(0)
+        self._condition.acquire()
+        for name in wanted:
+            self._extracted[name] = True
+        self._condition.notify_all()
+        self._condition.release()
+
+
+    def _extract_7z(self):
+        """Extract the files in the file list from a 7z archive. Files that
+        could not be extracted are still marked as "ready".
+
+        Members of non-solid archives are decompressed independently of
+        each other, so they are extracted a few at a time in the order of
+        the extraction queue, which follows set_priority(). A solid block
+        can only be decompressed from its start, so solid archives are
+        extracted by a single 7z process in archive order instead of
+        decompressing the same blocks again for each group of files.
+        """
+        if _7z_exec is None:
+            print '! Could not find 7z file extractor.'
+        elif self._7z_solid:
+            self._run_7z(self._files)
+        else:
+            names = self._next_files(_7Z_CHUNK_FILES)
+            while names:
+                self._run_7z(names)
+                names = self._next_files(_7Z_CHUNK_FILES)
+        self._condition.acquire()
+        for name in self._files:
+            self._extracted[name] = True
+        self._condition.notify_all()
+        self._condition.release()
+
+    def _run_7z(self, names):
+        """Run 7z to extract the files in <names>, which are passed to it
+        in a temporary list file.
+        """
+        list_path = _write_7z_list_file(names)
+        try:
+            self._run_7z_list(list_path)
+        finally:
+            os.remove(list_path)
+
+    def _run_7z_list(self, list_path):
+        """Run 7z to extract the files named in the list file at
+        <list_path>, skipping files that already exist. Each file is marked
+        as "ready" as soon as 7z reports it extracted.
+        """
+        args = [_7z_exec, 'x', self._rarpass, '-y', '-aos', '-bd']
+        if _get_7z_bb_support():
+            args += ['-bb1', '-bse1']
+        if _get_7z_spd_support():
+            args.append('-spd')
+        proc = process.Process(args + ['-o' + self._dst, '--', self._src,
+            '@' + list_path])
+        fd = proc.spawn()
+        if fd is None:
+            return
+        try:
+            line = fd.readline()
+            while line:
+                if self._stop:
+                    break
+                fname = None
+                if line.startswith('Extracting  '):
+                    fname = line[12:].rstrip('\r\n')
+                    if fname.endswith('     Data Error in encrypted file. Wrong password?'):
+                        fname = fname[:-50]
+                elif line.startswith('- ') or line.startswith('T '):
+                    fname = line[2:].rstrip('\r\n')
+                if fname is not None:
+                    self._condition.acquire()
+                    self._extracted[fname] = True
+                    self._condition.notify()
+                    self._condition.release()
+                line = fd.readline()
+        except Exception:
+            traceback.print_exc()
+        # Closing the pipe early makes 7z exit on SIGPIPE.
+        fd.close()
+        proc.wait()
+        if self._stop:
+            self.close()
+            sys.exit(0)
+
 
 class Packer:
     
@@ -494,20 +776,228 @@ def get_name(archive_type):
 def get_archive_info(path):
     """Return a tuple (mime, num_pages, size) with info about the archive
     at <path>, or None if <path> doesn't point to a supported archive.
+
+    No password is asked for, so this may be called from worker threads
+    and processes.
     """
-    image_re = re.compile(r'\.(jpg|jpeg|png|gif|tif|tiff)\s*$', re.I)
-    extractor = Extractor()
-    extractor.setup(path, None)
-    mime = extractor.get_mime_type()
+    mime = archive_mime_type(path)
     if mime is None:
         return None
-    files = extractor.get_files()
-    extractor.close()
+    files = list_files(path)
+    image_re = re.compile(r'\.(jpg|jpeg|png|gif|tif|tiff)\s*$', re.I)
     num_pages = len(filter(image_re.search, files))
     size = os.stat(path).st_size
     return (mime, num_pages, size)
 
 
+def list_files(path):
+    """Return a list of the names of the files in the archive at <path>,
+    without asking for a password. The list is empty if the archive could
+    not be read, or if its file names are encrypted.
+    """
+    files = []
+    def record(names):
+        files.extend(names)
+        return None
+    read_chosen_file(path, record)
+    return files
+
+
+def read_chosen_file(path, choose):
+    """Return a tuple (name, data) with the name and the contents of one
+    file in the archive at <path>, without extracting anything to disk.
+    The file is chosen by the function <choose>, which is given a list of
+    the names of all the files in the archive and should return one of
+    them, or None.
+
+    Return None if no file was chosen, or if the file could not be read.
+    Encrypted archives are never read, since that would need a password
+    to be entered.
+    """
+    try:
+        mime = archive_mime_type(path)
+        if mime == ZIP:
+            return _read_chosen_zip_file(path, choose)
+        if mime in (TAR, GZIP, BZIP2):
+            return _read_chosen_tar_file(path, choose)
+        if mime == RAR:
+            return _read_chosen_rar_file(path, choose)
+        if mime == P7ZIP:
+            return _read_chosen_7z_file(path, choose)
+    except Exception:
+        print '! Could not read from archive', path
+    return None
+
+
+def _read_chosen_zip_file(path, choose):
+    """Implement read_chosen_file() for ZIP archives."""
+    zfile = zipfile.ZipFile(path, 'r')
+    try:
+        name = choose(zfile.namelist())
+        if name is None:
+            return None
+        info = zfile.getinfo(name)
+        if info.flag_bits & 0x1:
+            return None
+        if info.compress_type == zipfile.ZIP_STORED:
+            return name, _read_stored_zip_member(path, info)
+        return name, zfile.read(name)
+    finally:
+        zfile.close()
+
+
+def _read_chosen_tar_file(path, choose):
+    """Implement read_chosen_file() for (compressed) tar archives."""
+    tfile = tarfile.open(path, 'r')
+    try:
+        name = choose(tfile.getnames())
+        if name is None:
+            return None
+        member = tfile.extractfile(name)
+        if member is None:
+            return None
+        return name, member.read()
+    finally:
+        tfile.close()
+
+
+def _read_chosen_rar_file(path, choose):
+    """Implement read_chosen_file() for RAR archives. Stored members are
+    read directly from the archive file, other members through the
+    output of a single "unrar p" process.
+    """
+    global _rar_exec
+    index = rarreader.read_index(path)
+    if index is not None:
+        members = dict([(m.name, m) for m in index])
+        name = choose(members.keys())
+        if name is None or members[name].encrypted:
+            return None
+        member = members[name]
+        if member.is_seekable():
+            fd = open(path, 'rb')
+            try:
+                fd.seek(member.offset)
+                return name, fd.read(member.unpacked_size)
+            finally:
+                fd.close()
+    if _rar_exec is None:
+        _rar_exec = _get_rar_exec()
+        if _rar_exec is None:
+            return None
+    if index is None:
+        proc = process.Process([_rar_exec, 'vb', '-p-', '--', path])
+        fd = proc.spawn()
+        if fd is None:
+            return None
+        names = [line.rstrip(os.linesep) for line in fd.readlines()]
+        fd.close()
+        proc.wait()
+        name = choose(names)
+        if name is None:
+            return None
+    proc = process.Process([_rar_exec, 'p', '-inul', '-p-', '--', path,
+        name], merge_stderr=False)
+    fd = proc.spawn()
+    if fd is None:
+        return None
+    data = fd.read()
+    fd.close()
+    if proc.wait() != 0 or not data:
+        return None
+    return name, data
+
+
+def _read_chosen_7z_file(path, choose):
+    """Implement read_chosen_file() for 7z archives, through the output
+    of a single "7z e -so" process.
+    """
+    global _7z_exec
+    if _7z_exec is None:
+        _7z_exec = _get_7z_exec()
+        if _7z_exec is None:
+            return None
+    proc = process.Process([_7z_exec, 'l', '-slt', '-p-', path])
+    fd = proc.spawn()
+    if fd is None:
+        return None
+    names = []
+    encrypted = False
+    for line in fd:
+        if line.startswith('Path = '):
+            names.append(line[7:-1])
+        elif line.startswith('Encrypted = +'):
+            encrypted = True
+    fd.close()
+    proc.wait()
+    # The first path listed is that of the archive itself.
+    name = choose(names[1:])
+    if name is None or encrypted:
+        return None
+    args = [_7z_exec, 'e', '-so', '-p-']
+    if _get_7z_spd_support():
+        args.append('-spd')
+    list_path = _write_7z_list_file([name])
+    try:
+        proc = process.Process(args + ['--', path, '@' + list_path],
+            merge_stderr=False)
+        fd = proc.spawn()
+        if fd is None:
+            return None
+        data = fd.read()
+        fd.close()
+        if proc.wait() != 0 or not data:
+            return None
+    finally:
+        os.remove(list_path)
+    return name, data
+
+
+def _write_7z_list_file(names):
+    """Write <names> to a new temporary list file for 7z, one per line,
+    and return its path. Names given in a list file (after "--" for the
+    archive path) can not be mistaken for switches, and are not matched
+    as wildcards if the -spd switch is supported.
+    """
+    fd, list_path = tempfile.mkstemp(prefix='comix.', suffix='.lst')
+    list_file = os.fdopen(fd, 'w')
+    try:
+        list_file.write(''.join([name + '\n' for name in names]))
+    finally:
+        list_file.close()
+    return list_path
+
+
+def _read_stored_zip_member(path, info):
+    """Return the data of the stored (uncompressed) member described by the
+    ZipInfo <info>, read directly from the ZIP archive at <path>.
+    """
+    fd = open(path, 'rb')
+    try:
+        fd.seek(info.header_offset)
+        header = fd.read(30)
+        if header[:4] != 'PK\x03\x04':
+            raise zipfile.BadZipfile('Bad local file header')
+        name_size, extra_size = struct.unpack('<HH', header[26:30])
+        fd.seek(info.header_offset + 30 + name_size + extra_size)
+        return fd.read(info.file_size)
+    finally:
+        fd.close()
+
+
+def _copy_bytes(src, dst, size):
+    """Copy <size> bytes from the file object <src> to the file object
+    <dst> in chunks. If <dst> is None the bytes are read and discarded.
+    """
+    while size > 0:
+        data = src.read(min(size, 65536))
+        if not data:
+            break
+        if dst is not None:
+            dst.write(data)
+        size -= len(data)
+
+
 def _get_rar_exec():
     """Return the name of the RAR file extractor executable, or None if
     no such executable is found.
@@ -517,6 +1007,39 @@ def _get_rar_exec():
             return command
     return None
 
+def _get_7z_bb_support():
+    """Return True if the 7z file extractor supports the -bb switch, which
+    is then needed to make it list the files it extracts.
+    """
+    return _has_7z_switch('-bb[0-3]')
+
+
+def _get_7z_spd_support():
+    """Return True if the 7z file extractor supports the -spd switch, which
+    disables wildcard matching for file names.
+    """
+    return _has_7z_switch('-spd')
+
+
+def _has_7z_switch(switch):
+    """Return True if <switch> is listed in the help output of the 7z file
+    extractor. The executable is only probed once per process.
+    """
+    global _7z_help
+    if _7z_help is None:
+        _7z_help = []
+        proc = process.Process([_7z_exec, '-h'])
+        fd = proc.spawn()
+        if fd is not None:
+            _7z_help = fd.readlines()
+            fd.close()
+            proc.wait()
+    for line in _7z_help:
+        if line.startswith('  ' + switch):
+            return True
+    return False
+
+
 def _get_7z_exec():
     """Return the name of the 7z file extractor executable, or None if
     no such executable is found.
@@ -31,6 +31,7 @@ try:
     import pygtk
     pygtk.require('2.0')
     import gtk
+    import gobject
     assert gtk.gtk_version >= (2, 12, 0)
     assert gtk.pygtk_version >= (2, 12, 0)
 except AssertionError:
@@ -70,6 +71,7 @@ import locale
 import main
 import icons
 import preferences
+import profiler
 
 
 def print_help():
@@ -81,6 +83,10 @@ def print_help():
     print '  -h, --help              Show this help and exit.'
     print '  -f, --fullscreen        Start the application in fullscreen mode.'
     print '  -l, --library           Show the library on startup.'
+    print '  -p, --profile           Show timings of page draws in the statusbar.'
+    print
+    print 'If the environment variable COMIX_PROFILE is set to a filename,'
+    print 'the timings of page draws are also written to that file.'
     sys.exit(1)
 
 
@@ -102,8 +108,8 @@ def run():
     open_path = None
     open_page = 1
     try:
-        opts, args = getopt.gnu_getopt(sys.argv[1:], 'fhl',
-            ['fullscreen', 'help', 'library'])
+        opts, args = getopt.gnu_getopt(sys.argv[1:], 'fhlp',
+            ['fullscreen', 'help', 'library', 'profile'])
     except getopt.GetoptError:
         print_help()
     for opt, value in opts:
@@ -113,11 +119,18 @@ def run():
             fullscreen = True
         elif opt in ('-l', '--library'):
             show_library = True
+        elif opt in ('-p', '--profile'):
+            profiler.enable()
+    if os.environ.get('COMIX_PROFILE'):
+        profiler.enable(os.environ['COMIX_PROFILE'])
 
     if not os.path.exists(constants.DATA_DIR):
         os.makedirs(constants.DATA_DIR, 0700)
     if not os.path.exists(constants.CONFIG_DIR):
         os.makedirs(constants.CONFIG_DIR, 0700)
+    # Let other threads (extraction, pixbuf prefetching) run while the main
+    # thread is idle in the GTK main loop or busy in GTK/GDK calls.
+    gobject.threads_init()
     deprecated.move_files_to_xdg_dirs()
     preferences.read_preferences_file()
     icons.load_icons()
@@ -178,7 +178,8 @@ class _ImageArea(gtk.ScrolledWindow):
             thumb = self._edit_dialog.file_handler.get_thumbnail(
                 page, 67, 100, create=False)
             thumb = image.add_border(thumb, 1, 0x555555FF)
-            path = self._edit_dialog.file_handler.get_path_to_page(page)
+            path = self._edit_dialog.file_handler.get_extracted_path_to_page(
+                page)
             self._liststore.append([thumb,
                 encoding.to_unicode(os.path.basename(path)), path])
             if page % 10 == 0:
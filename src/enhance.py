@@ -9,6 +9,10 @@ import image
 
 _dialog = None
 
+# The histogram in the dialog is computed from a downsampled copy of images
+# that have more pixels than this.
+_HISTOGRAM_MAX_PIXELS = 500000
+
 
 class ImageEnhancer:
 
@@ -34,6 +38,11 @@ class ImageEnhancer:
                 self.saturation, self.sharpness, self.autocontrast)
         return pixbuf
 
+    def get_values(self):
+        """Return a tuple with the current enhancement values."""
+        return (self.brightness, self.contrast, self.saturation,
+            self.sharpness, self.autocontrast)
+
     def signal_update(self):
         """Signal to the main window that a change in the enhancement
         values has been made.
@@ -146,7 +155,7 @@ class _EnhanceImageDialog(gtk.Dialog):
         pixbuf = image.get_pixbuf()
         if pixbuf is not None:
             self._hist_image.set_from_pixbuf(histogram.draw_histogram(pixbuf,
-                text=False))
+                text=False, max_pixels=_HISTOGRAM_MAX_PIXELS))
 
     def clear_histogram(self):
         """Clear the histogram in the dialog."""
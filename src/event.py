@@ -13,6 +13,10 @@ import cursor
 import preferences
 from preferences import prefs
 
+# Time (in ms) that the window size must be unchanged before the pages are
+# redrawn in full quality after a resize.
+_RESIZE_SETTLE_DELAY = 150
+
 
 class EventHandler:
 
@@ -23,9 +27,15 @@ class EventHandler:
         self._pressed_pointer_pos_x = 0
         self._pressed_pointer_pos_y = 0
         self._extra_scroll_events = 0 # For scrolling "off the page".
+        self._resize_source = None
 
     def resize_event(self, widget, event):
-        """Handle events from resizing and moving the main window."""
+        """Handle events from resizing and moving the main window.
+
+        While the window is being resized, the pages are drawn as quick
+        previews. They are drawn in full quality once the size has been
+        stable for a short while.
+        """
         if not self._window.is_fullscreen:
             prefs['window x'], prefs['window y'] = self._window.get_position()
         if (event.width != self._window.width or
@@ -35,7 +45,17 @@ class EventHandler:
                 prefs['window height'] = event.height
             self._window.width = event.width
             self._window.height = event.height
-            self._window.draw_image(scroll=False)
+            self._window.draw_image(scroll=False, preview=True)
+            if self._resize_source is not None:
+                gobject.source_remove(self._resize_source)
+            self._resize_source = gobject.timeout_add(_RESIZE_SETTLE_DELAY,
+                self._resize_settled)
+
+    def _resize_settled(self):
+        """Redraw the pages in full quality after a resize."""
+        self._resize_source = None
+        self._window.draw_image(scroll=False)
+        return False
 
     def key_press_event(self, widget, event, *args):
         """Handle key press events on the main window."""
@@ -1,11 +1,15 @@
 """filechooser.py - Custom FileChooserDialog implementations."""
 
+import bisect
 import os
+import threading
 
 import gtk
 import pango
 
+import archive
 import encoding
+import filehandler
 import image
 import labels
 from preferences import prefs
@@ -13,6 +17,9 @@ import thumbnail
 
 _main_filechooser_dialog = None
 _library_filechooser_dialog = None
+# The number of files following the previewed one that get thumbnails
+# created in advance, so that they are ready when they are previewed.
+_THUMBNAIL_LOOK_AHEAD = 4
 
 
 class _ComicFileChooserDialog(gtk.Dialog):
@@ -72,6 +79,13 @@ class _ComicFileChooserDialog(gtk.Dialog):
         self.filechooser.set_use_preview_label(False)
         preview_box.show_all()
         self.filechooser.connect('update-preview', self._update_preview)
+        self._thumbnail_generation = 0
+        self._thumbnail_results = None # Of thumbnail.generate_many().
+        self._thumbnail_lock = threading.Lock()
+        self._listing = (None, []) # A folder and the sorted names in it.
+        self.filechooser.connect('current_folder_changed',
+            self._forget_listing)
+        self.connect('destroy', self._stop_generating_thumbnails)
 
         ffilter = gtk.FileFilter()
         ffilter.add_pattern('*')
@@ -167,12 +181,87 @@ class _ComicFileChooserDialog(gtk.Dialog):
                     os.path.basename(path)))
                 self._sizelabel.set_text(
                     '%.1f KiB' % (os.stat(path).st_size / 1024.0))
+            if self._action == gtk.FILE_CHOOSER_ACTION_OPEN:
+                self._generate_thumbnails(path)
         else:
             self._preview_image.clear()
             self._namelabel.set_text('')
             self._sizelabel.set_text('')
 
 
+    def _generate_thumbnails(self, path):
+        """Start creating thumbnails for the few files that follow <path>
+        in its folder in the background, so that they are ready to be
+        previewed next.
+        """
+        self._stop_generating_thumbnails()
+        if not prefs['create thumbnails']:
+            return
+        thread = threading.Thread(target=self._thread_generate_thumbnails,
+            args=(path, self._thumbnail_generation))
+        thread.setDaemon(False)
+        thread.start()
+
+    def _forget_listing(self, *args):
+        """Make the folder be listed anew the next time thumbnails are
+        created, so that files added to it are seen.
+        """
+        self._listing = (None, [])
+
+    def _stop_generating_thumbnails(self, *args):
+        """Stop creating thumbnails for the previously previewed file, if
+        any.
+        """
+        self._thumbnail_lock.acquire()
+        self._thumbnail_generation += 1
+        if self._thumbnail_results is not None:
+            self._thumbnail_results.close()
+            self._thumbnail_results = None
+        self._thumbnail_lock.release()
+
+    def _thread_generate_thumbnails(self, path, generation):
+        """Create thumbnails for the next _THUMBNAIL_LOOK_AHEAD images and
+        archives after <path> in its folder, until another file is
+        previewed (and <generation> is no longer the current one), which
+        closes the results. This is run in a separate thread.
+
+        The thumbnails are created in this process. Forking worker
+        processes from the threaded GUI process, for every file previewed,
+        would cost more than the few thumbnails are worth.
+        """
+        folder, name = os.path.split(path)
+        listed_folder, names = self._listing
+        if folder != listed_folder:
+            try:
+                names = os.listdir(folder)
+            except OSError:
+                return
+            names.sort()
+            self._listing = (folder, names)
+        paths = []
+        for name in names[bisect.bisect_right(names, name):]:
+            if (generation != self._thumbnail_generation or
+              len(paths) >= _THUMBNAIL_LOOK_AHEAD):
+                break
+            next_path = os.path.join(folder, name)
+            if (archive.archive_mime_type(next_path) is not None or
+              filehandler.is_image_file(next_path)):
+                paths.append(next_path)
+        self._thumbnail_lock.acquire()
+        if generation != self._thumbnail_generation:
+            self._thumbnail_lock.release()
+            return
+        results = thumbnail.generate_many(paths, workers=1)
+        self._thumbnail_results = results
+        self._thumbnail_lock.release()
+        for path, success in results:
+            pass
+        self._thumbnail_lock.acquire()
+        if self._thumbnail_results is results:
+            self._thumbnail_results = None
+        self._thumbnail_lock.release()
+
+
 class _MainFileChooserDialog(_ComicFileChooserDialog):
     
     """The normal filechooser dialog used with the "Open" menu item."""
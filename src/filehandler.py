@@ -1,7 +1,6 @@
 """filehandler.py - File handler."""
 
 import os
-import sys
 import shutil
 import locale
 import tempfile
@@ -16,11 +15,18 @@ import archive
 import cursor
 import encoding
 import image
+import pixbufcache
 from preferences import prefs
+import profiler
 import thumbnail
+import thumbpack
 
 from archive import hfs_hack
 
+# The smallest size of the thumbnails in thumbnail packs, which is large
+# enough for the 67x100 thumbnails of the edit archive dialog too.
+_MIN_PACK_THUMBNAIL_SIZE = 100
+
 class FileHandler:
 
     """The FileHandler keeps track of images, pages, caches and reads files.
@@ -37,6 +43,7 @@ class FileHandler:
     def __init__(self, window):
         self.file_loaded = False
         self.archive_type = None
+        self._pages_in_memory = False
 
         self._window = window
         self._base_path = None
@@ -44,67 +51,150 @@ class FileHandler:
         self._image_files = []
         self._current_image_index = None
         self._comment_files = []
-        self._raw_pixbufs = {}
+        self._raw_pixbufs = pixbufcache.PixbufCache(
+            prefs['cache size'] * 1048576)
+        self._full_sizes = {} # index: full size of pixbufs decoded reduced
+        self._reading_forward = True
         self._name_table = {}
+        self._thumbnail_pack = None
+        self._prefetch_thread = None
+        self._prefetch_condition = threading.Condition()
+        self._prefetch_queue = []
+        self._prefetch_busy = None
+        # Incremented every time a file is closed, so that other threads
+        # can tell when their work has become obsolete.
+        self._generation = 0
+        self._stopped = False
         self._extractor = archive.Extractor()
         self._condition = None
         self._image_re = re.compile(r'\.(jpg|jpeg|png|gif|bmp|tif|tiff)\s*$', re.I)
         self.update_comment_extensions()
 
-    def _get_pixbuf(self, index):
+    def _get_pixbuf(self, index, full_size=False):
         """Return the pixbuf indexed by <index> from cache.
-        Pixbufs not found in cache are fetched from disk first.
+        Pixbufs not found in cache are fetched from disk first. If the
+        pixbuf is being decoded by the prefetch thread, wait for it.
+
+        Unless <full_size> is True, the pixbuf may have been decoded at a
+        reduced size that is still large enough for the current zoom mode
+        (see image.load_animation_for_display()).
         """
-        if index not in self._raw_pixbufs:
-            self._wait_on_page(index + 1)
+        if full_size:
+            fit_box = None
+        else:
+            fit_box = self._window.get_fit_box()
+        pixbuf = self._get_cached_pixbuf(index, fit_box)
+        if pixbuf is None:
+            start = profiler.clock()
+            self._prefetch_condition.acquire()
+            while self._prefetch_busy == index:
+                self._prefetch_condition.wait()
+            self._prefetch_condition.release()
+            profiler.add('wait', start)
+            pixbuf = self._get_cached_pixbuf(index, fit_box)
+        if pixbuf is None:
             try:
-                self._raw_pixbufs[index] = gtk.gdk.PixbufAnimation(
-                    self._image_files[index])
+                if not self._pages_in_memory:
+                    start = profiler.clock()
+                    self._wait_on_page(index + 1)
+                    profiler.add('wait', start)
+                start = profiler.clock()
+                pixbuf, size = self._decode(index, self._image_files[index],
+                    self._name_table.get(self._image_files[index]),
+                    self._pages_in_memory, fit_box)
+                profiler.add('decode', start)
             except Exception:
-                self._raw_pixbufs[index] = self._get_missing_image()
-        return self._raw_pixbufs[index]
+                pixbuf, size = self._get_missing_image(), None
+            self._put_pixbuf(index, pixbuf, size)
+        return pixbuf
+
+    def get_cached_pixbuf(self, index):
+        """Return the pixbuf indexed by <index> if it is in the cache, and
+        large enough for the current zoom mode, or None otherwise. This
+        never blocks.
+        """
+        return self._get_cached_pixbuf(index, self._window.get_fit_box())
 
-    def get_pixbufs(self, single=False):
+    def get_pixbufs(self, single=False, full_size=False):
         """Return the pixbuf(s) for the image(s) that should be currently
         displayed, from cache. Return two pixbufs in double-page mode unless
         <single> is True. Pixbufs not found in cache are fetched from
         disk first.
+
+        Unless <full_size> is True, the pixbufs may be smaller than the
+        actual images, but never smaller than they are displayed in the
+        current zoom mode. Use get_full_size() to get the real image sizes.
         """
         if not self._window.displayed_double() or single:
-            return self._get_pixbuf(self._current_image_index)
-        return (self._get_pixbuf(self._current_image_index),
-                self._get_pixbuf(self._current_image_index + 1))
+            return self._get_pixbuf(self._current_image_index, full_size)
+        return (self._get_pixbuf(self._current_image_index, full_size),
+                self._get_pixbuf(self._current_image_index + 1, full_size))
+
+    def get_full_size(self, index, pixbuf):
+        """Return a tuple (width, height) with the full size of the image
+        that <pixbuf>, as returned for page <index> (indexed from 0), was
+        decoded from.
+        """
+        size = self._full_sizes.get(index)
+        if size is None:
+            return pixbuf.get_width(), pixbuf.get_height()
+        return size
 
     def do_cacheing(self):
-        """Make sure that the correct pixbufs are stored in cache. These
-        are (in the current implementation) the current image(s), and
-        if cacheing is enabled, also the one or two pixbufs before and
-        after them. All other pixbufs are deleted and garbage collected
-        directly in order to save memory.
-        """
-        # Get list of wanted pixbufs.
-        first_wanted = self._current_image_index
-        last_wanted = first_wanted + 1
+        """Make sure that the correct pixbufs are stored in cache. The
+        current image(s) are always cached. If cacheing is enabled, a number
+        of pages ahead in the reading direction, and one step back, are
+        also queued for decoding by the prefetch thread. Old pixbufs are
+        then evicted from the cache in least recently used order when it
+        grows beyond its size limit, except for the current image(s). If cacheing is disabled, all other
+        pixbufs are removed directly in order to save memory.
+        """
+        first_current = self._current_image_index
+        last_current = first_current + 1
         if self._window.is_double_page:
-            last_wanted += 1
-        if prefs['cache']:
-            first_wanted -= self._get_backward_step_length()
-            last_wanted += self._get_forward_step_length()
-        first_wanted = max(0, first_wanted)
-        last_wanted = min(self.get_number_of_pages(), last_wanted)
-        wanted_pixbufs = range(first_wanted, last_wanted)
-        
-        # Remove old pixbufs.
-        for page in set(self._raw_pixbufs) - set(wanted_pixbufs):
-            del self._raw_pixbufs[page]
-        if sys.version_info[:3] >= (2, 5, 0):
-            gc.collect(0)
+            last_current += 1
+        last_current = min(self.get_number_of_pages(), last_current)
+        current = range(first_current, last_current)
+        # Pages decoded ahead must not evict the pages on display.
+        self._raw_pixbufs.pin(current)
+        for index in current:
+            self._get_pixbuf(index)
+        if not prefs['cache']:
+            self._raw_pixbufs.keep_only(current)
+            return
+
+        # Double stepping covers twice as many pages per page flip, so we
+        # decode twice as many pages ahead.
+        forward_step = self._get_forward_step_length()
+        backward_step = self._get_backward_step_length()
+        if self._reading_forward:
+            ahead = prefs['number of pages to cache ahead'] * forward_step
+            wanted = (range(last_current, last_current + ahead) +
+                range(first_current - 1, first_current - backward_step - 1,
+                -1))
         else:
-            gc.collect()
-        
-        # Cache new pixbufs if they are not already cached.
-        for wanted in wanted_pixbufs:
-            self._get_pixbuf(wanted)
+            ahead = prefs['number of pages to cache ahead'] * backward_step
+            wanted = (range(first_current - 1, first_current - ahead - 1,
+                -1) + range(last_current, last_current + forward_step))
+        fit_box = self._window.get_fit_box()
+        wanted = [p for p in wanted if 0 <= p < self.get_number_of_pages()
+            and self._get_cached_pixbuf(p, fit_box) is None]
+
+        self._prefetch_condition.acquire()
+        self._prefetch_queue[:] = [(p, self._image_files[p],
+            self._name_table.get(self._image_files[p]), fit_box)
+            for p in wanted]
+        self._prefetch_condition.notify_all()
+        self._prefetch_condition.release()
+        if self._prefetch_thread is None and wanted:
+            self._prefetch_thread = threading.Thread(
+                target=self._thread_prefetch)
+            self._prefetch_thread.setDaemon(False)
+            self._prefetch_thread.start()
+
+    def update_cache_size(self):
+        """Update the size limit of the pixbuf cache from the preferences."""
+        self._raw_pixbufs.set_max_size(prefs['cache size'] * 1048576)
 
     def next_page(self):
         """Set up filehandler to the next page. Return True if this results
@@ -123,6 +213,8 @@ class FileHandler:
                 self._open_next_archive()
             return False
         self._current_image_index += self._get_forward_step_length()
+        self._reading_forward = True
+        self._update_extraction_order()
         return old_page != self.get_current_page()
 
     def previous_page(self):
@@ -143,6 +235,8 @@ class FileHandler:
         step = self._get_backward_step_length()
         step = min(self._current_image_index, step)
         self._current_image_index -= step
+        self._reading_forward = False
+        self._update_extraction_order()
         if (step == 2 and self.get_virtual_double_page()):
             self._current_image_index += 1
         return old_page != self.get_current_page()
@@ -155,6 +249,8 @@ class FileHandler:
             return False
         old_page = self.get_current_page()
         self._current_image_index = 0
+        self._reading_forward = True
+        self._update_extraction_order()
         return old_page != self.get_current_page()
 
     def last_page(self):
@@ -167,6 +263,8 @@ class FileHandler:
         offset = self._window.is_double_page and 2 or 1
         offset = min(self.get_number_of_pages(), offset)
         self._current_image_index = self.get_number_of_pages() - offset
+        self._reading_forward = False
+        self._update_extraction_order()
         if (offset == 2 and self.get_virtual_double_page()):
             self._current_image_index += 1
         return old_page != self.get_current_page()
@@ -179,6 +277,8 @@ class FileHandler:
             return False
         old_page = self.get_current_page()
         self._current_image_index = page_num - 1
+        self._reading_forward = page_num >= old_page
+        self._update_extraction_order()
         return old_page != self.get_current_page()
 
     def get_virtual_double_page(self):
@@ -238,8 +338,12 @@ class FileHandler:
 
         # If <path> is an archive we create an Extractor for it and set the
         # files in it with file endings indicating image files or comments
-        # as the ones to be extracted.
+        # as the ones to be extracted. Pages in ZIP archives can be read
+        # directly into memory instead, then only the comments are extracted
+        # (and pages only when something needs them on disk).
         if self.archive_type is not None:
+            self._pages_in_memory = (self.archive_type == archive.ZIP and
+                prefs['read zip pages into memory'])
             self._base_path = path
             self._condition = self._extractor.setup(path, self._tmp_dir)
             files = self._extractor.get_files()
@@ -258,6 +362,8 @@ class FileHandler:
                 self._name_table[full_path] = name
             for name, full_path in zip(comment_files, self._comment_files):
                 self._name_table[full_path] = name
+            self._thumbnail_pack = thumbpack.ThumbnailPack(path,
+                max(prefs['thumbnail size'], _MIN_PACK_THUMBNAIL_SIZE))
 
             if start_page <= 0:
                 if self._window.is_double_page:
@@ -268,20 +374,17 @@ class FileHandler:
                 self._current_image_index = start_page - 1
             self._current_image_index = max(0, self._current_image_index)
 
-            depth = self._window.is_double_page and 2 or 1
-            priority_ordering = (
-                range(self._current_image_index,
-                    self._current_image_index + depth * 2) +
-                range(self._current_image_index - depth,
-                    self._current_image_index)[::-1])
-            priority_ordering = [image_files[p] for p in priority_ordering
-                if 0 <= p <= self.get_number_of_pages() - 1]
+            priority_ordering = [image_files[p]
+                for p in self._get_priority_ordering()]
             for i, name in enumerate(priority_ordering):
                 image_files.remove(name)
                 image_files.insert(i, name)
 
-            self._extractor.set_files(image_files + comment_files)
-            self._extractor.extract()
+            if self._pages_in_memory:
+                self._extractor.set_files(comment_files)
+            else:
+                self._extractor.set_files(image_files + comment_files)
+            self._extractor.extract(prefs['number of extraction threads'])
         # If <path> is an image we scan its directory for more images.
         else:
             self._base_path = os.path.dirname(path)
@@ -309,12 +412,17 @@ class FileHandler:
     def close_file(self, *args):
         """Run tasks for "closing" the currently opened file(s)."""
         self.file_loaded = False
+        self._pages_in_memory = False
         self._base_path = None
         self._image_files = []
         self._current_image_index = None
         self._comment_files = []
         self._name_table.clear()
+        self._cancel_prefetch()
+        self._close_thumbnail_pack()
         self._raw_pixbufs.clear()
+        self._full_sizes.clear()
+        self._reading_forward = True
         self._window.clear()
         self._window.ui_manager.set_sensitivities()
         self._extractor.stop()
@@ -324,6 +432,9 @@ class FileHandler:
 
     def cleanup(self):
         """Run clean-up tasks. Should be called prior to exit."""
+        self._stopped = True
+        self._cancel_prefetch()
+        self._close_thumbnail_pack()
         self._extractor.stop()
         thread_delete(self._tmp_dir)
 
@@ -389,6 +500,14 @@ class FileHandler:
             return self._image_files[self._current_image_index]
         return self._image_files[page - 1]
 
+    def get_extracted_path_to_page(self, page=None):
+        """Return the full path to the image file for <page>, or the current
+        page if <page> is None, after making sure that the file has been
+        extracted to disk.
+        """
+        self._wait_on_page(page)
+        return self.get_path_to_page(page)
+
     def get_path_to_base(self):
         """Return the full path to the current base (path to archive or
         image directory.)
@@ -432,21 +551,81 @@ class FileHandler:
         If <create> is True, and <width>x<height> <= 128x128, the
         thumbnail is also stored on disk.
         """
-        self._wait_on_page(page)
-        path = self.get_path_to_page(page)
-        if width <= 128 and height <= 128:
-            thumb = thumbnail.get_thumbnail(path, create)
-        else:
-            try:
-                thumb = gtk.gdk.pixbuf_new_from_file_at_size(path, width,
-                    height)
-            except Exception:
-                thumb = None
+        if page is None:
+            page = self.get_current_page()
+        thumb = self.load_thumbnail(page, width, height, create)
         if thumb is None:
-            thumb = self._get_missing_image()
-        thumb = image.fit_in_rectangle(thumb, width, height)
+            thumb = image.fit_in_rectangle(self._get_missing_image(), width,
+                height)
         return thumb
 
+    def load_thumbnail(self, page, width=128, height=128, create=False):
+        """Return a thumbnail pixbuf of <page> like get_thumbnail() does,
+        but return None instead of a missing image icon if the thumbnail
+        could not be made.
+
+        Unlike get_thumbnail(), this may be called from threads other than
+        the main thread. If the file is closed while waiting for <page> to
+        be extracted, None is returned right away.
+
+        Page thumbnails of archives that are no larger than the thumbnails
+        in the thumbnail pack of the archive (see thumbpack.py), i.e. the
+        configured thumbnail size but at least _MIN_PACK_THUMBNAIL_SIZE,
+        are taken from, or added to, the pack and scaled down.
+        """
+        generation = self._generation
+        condition = self._condition
+        pack = self._thumbnail_pack
+        if self._stopped:
+            return None
+        load_width, load_height = width, height
+        if (pack is not None and width <= pack.get_size() and
+          height <= pack.get_size()):
+            thumb = pack.get(page)
+            if thumb is not None:
+                return image.fit_in_rectangle(thumb, width, height)
+            load_width = load_height = pack.get_size()
+        else:
+            pack = None
+        try:
+            path = self._image_files[page - 1]
+            name = self._name_table.get(path)
+            if self._pages_in_memory:
+                thumb = image.load_pixbuf_at_size(
+                    self._extractor.read_file(name), load_width, load_height)
+            else:
+                if name is not None and not self._wait_on_file_in_thread(
+                  name, condition, generation):
+                    return None
+                if load_width <= 128 and load_height <= 128:
+                    thumb = thumbnail.get_thumbnail(path, create)
+                else:
+                    thumb = gtk.gdk.pixbuf_new_from_file_at_size(path,
+                        load_width, load_height)
+        except Exception:
+            return None
+        if thumb is None:
+            return None
+        if pack is not None:
+            thumb = image.fit_in_rectangle(thumb, load_width, load_height)
+            pack.put(page, thumb)
+        return image.fit_in_rectangle(thumb, width, height)
+
+    def is_thumbnail_ready(self, page):
+        """Return True if load_thumbnail() can make a thumbnail of <page>
+        right away, i.e. without waiting for it to be extracted first.
+        """
+        if self.archive_type is None or self._pages_in_memory:
+            return True
+        pack = self._thumbnail_pack
+        if pack is not None and page in pack:
+            return True
+        try:
+            return self._extractor.is_ready(
+                self._name_table[self._image_files[page - 1]])
+        except (IndexError, KeyError):
+            return True
+
     def get_stats(self, page=None):
         """Return a stat object, as used by the stat module, for <page>.
         If <page> is None, return a stat object for the current page.
@@ -459,6 +638,30 @@ class FileHandler:
             stats = None
         return stats
 
+    def _get_priority_ordering(self):
+        """Return a list of the indices of the pages around the current
+        page, in the order they are most likely to be needed: the current
+        page(s) and a few pages ahead, then a few pages behind.
+        """
+        depth = self._window.is_double_page and 2 or 1
+        priority_ordering = (
+            range(self._current_image_index,
+                self._current_image_index + depth * 2) +
+            range(self._current_image_index - depth,
+                self._current_image_index)[::-1])
+        return [p for p in priority_ordering
+            if 0 <= p <= self.get_number_of_pages() - 1]
+
+    def _update_extraction_order(self):
+        """Move the pages around the current page to the front of the
+        extraction queue, if they are not yet extracted.
+        """
+        if self.archive_type is None:
+            return
+        self._extractor.set_priority([
+            self._name_table[self._image_files[p]]
+            for p in self._get_priority_ordering()])
+
     def _get_forward_step_length(self):
         """Return the step length for switching pages forwards."""
         if (self._window.displayed_double() and 
@@ -507,6 +710,145 @@ class FileHandler:
                 self.open_file(path, 0)
                 return
 
+    def _cancel_prefetch(self):
+        """Empty the prefetch queue and make the prefetch thread drop the
+        pixbuf it is currently working on, if any.
+        """
+        self._prefetch_condition.acquire()
+        self._generation += 1
+        del self._prefetch_queue[:]
+        self._prefetch_condition.notify_all()
+        self._prefetch_condition.release()
+        # The prefetch thread might be waiting for a file to be extracted.
+        if self._condition is not None:
+            self._condition.acquire()
+            self._condition.notify_all()
+            self._condition.release()
+
+    def _close_thumbnail_pack(self):
+        """Close the thumbnail pack of the current archive, if any, and
+        delete old packs if they take up too much space.
+        """
+        if self._thumbnail_pack is not None:
+            self._thumbnail_pack.close()
+            self._thumbnail_pack = None
+            thumbpack.prune_packs()
+
+    def _thread_prefetch(self):
+        """Decode the pages in the prefetch queue and put them in the
+        pixbuf cache. This is run in a separate thread until cleanup() is
+        called.
+        """
+        while True:
+            self._prefetch_condition.acquire()
+            while not self._prefetch_queue and not self._stopped:
+                self._prefetch_condition.wait()
+            if self._stopped:
+                self._prefetch_condition.release()
+                return
+            index, path, name, fit_box = self._prefetch_queue.pop(0)
+            generation = self._generation
+            condition = self._condition
+            in_memory = self._pages_in_memory
+            self._prefetch_busy = index
+            self._prefetch_condition.release()
+
+            pixbuf = None
+            if self._get_cached_pixbuf(index, fit_box) is None:
+                try:
+                    if (in_memory or name is None or
+                      self._wait_on_file_in_thread(name, condition,
+                      generation)):
+                        pixbuf, size = self._decode(index, path, name,
+                            in_memory, fit_box)
+                except Exception:
+                    pixbuf = None
+
+            self._prefetch_condition.acquire()
+            if pixbuf is not None and generation == self._generation:
+                self._put_pixbuf(index, pixbuf, size)
+            self._prefetch_busy = None
+            self._prefetch_condition.notify_all()
+            self._prefetch_condition.release()
+
+    def _wait_on_file_in_thread(self, name, condition, generation):
+        """Block the running thread until the file <name> in the archive
+        has been extracted. Return True when it is ready, or False if the
+        archive was closed (so that <generation> is no longer the current
+        one) before then.
+        """
+        condition.acquire()
+        try:
+            while not self._extractor.is_ready(name):
+                if generation != self._generation:
+                    return False
+                condition.wait()
+            return generation == self._generation
+        finally:
+            condition.release()
+
+    def _decode(self, index, path, name, in_memory, fit_box):
+        """Decode page <index>, with the image file at <path> (that must
+        be ready), or read from the archive member <name> if <in_memory> is
+        True. Return a tuple (pixbuf, full size), where the full size is
+        None unless the pixbuf was decoded at a reduced size that is large
+        enough for <fit_box> (see image.load_animation_for_display()).
+        """
+        if in_memory:
+            data = self._extractor.read_file(name)
+        else:
+            fd = open(path, 'rb')
+            try:
+                data = fd.read()
+            finally:
+                fd.close()
+        pixbuf, size = image.load_animation_for_display(data, fit_box)
+        # The reduced size did not take EXIF rotation into account.
+        if not self._is_large_enough(pixbuf, size, fit_box):
+            pixbuf, size = image.load_animation(data), None
+        return pixbuf, size
+
+    def _get_cached_pixbuf(self, index, fit_box):
+        """Return the pixbuf indexed by <index> from cache if it is large
+        enough to be fitted in <fit_box>, or at full size if <fit_box> is
+        None. Otherwise return None.
+        """
+        pixbuf = self._raw_pixbufs.get(index)
+        if pixbuf is None or not self._is_large_enough(pixbuf,
+          self._full_sizes.get(index), fit_box):
+            return None
+        return pixbuf
+
+    def _put_pixbuf(self, index, pixbuf, size):
+        """Put <pixbuf> in cache as page <index>, where <size> is the full
+        size of the image if the pixbuf was decoded at a reduced size, or
+        None otherwise.
+        """
+        if size is None:
+            self._full_sizes.pop(index, None)
+        else:
+            self._full_sizes[index] = size
+        self._raw_pixbufs.put(index, pixbuf)
+
+    def _is_large_enough(self, pixbuf, size, fit_box):
+        """Return True if <pixbuf>, decoded from an image with full size
+        <size> (or None if it is at full size), is at least as large as
+        the image would be when fitted in <fit_box>.
+        """
+        if size is None:
+            return True
+        if fit_box is None:
+            return False
+        if hasattr(pixbuf, 'get_static_image'):
+            pixbuf = pixbuf.get_static_image()
+        width, height, scale_up, rotation = fit_box
+        if prefs['auto rotate from exif']:
+            rotation = (rotation + image.get_implied_rotation(pixbuf)) % 360
+        fitted_width, fitted_height = image.get_fitted_size(size[0],
+            size[1], width, height, scale_up, rotation)
+        return (pixbuf.get_width() >= fitted_width and
+            pixbuf.get_height() >= fitted_height)
+
     def _get_missing_image(self):
         """Return a pixbuf depicting a missing/broken image."""
         return self._window.render_icon(gtk.STOCK_MISSING_IMAGE,
@@ -534,6 +876,8 @@ class FileHandler:
         if self.archive_type is None:
             return
         name = self._name_table[path]
+        if self._pages_in_memory and path not in self._comment_files:
+            self._extractor.extract_file(name)
         self._condition.acquire()
         while not self._extractor.is_ready(name):
             self._condition.wait()
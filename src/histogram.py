@@ -4,11 +4,15 @@ import gtk
 from PIL import Image
 from PIL import ImageDraw
 from PIL import ImageOps
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 import image
 
 
-def draw_histogram(pixbuf, height=170, fill=170, text=True):
+def draw_histogram(pixbuf, height=170, fill=170, text=True, max_pixels=None):
     """Draw a histogram from <pixbuf> and return it as another pixbuf.
 
     The returned prixbuf will be 262x<height> px.
@@ -18,14 +22,76 @@ def draw_histogram(pixbuf, height=170, fill=170, text=True):
 
     If <text> is True a label with the maximum pixel value will be added to
     one corner.
+
+    If <max_pixels> is set and <pixbuf> has more pixels than that, the
+    histogram is computed from a downsampled copy of <pixbuf>, with the
+    counts scaled up correspondingly.
     """
-    im = Image.new('RGB', (258, height - 4), (30, 30, 30))
-    hist_data = image.pixbuf_to_pil(pixbuf).histogram()
-    maximum = max(hist_data[:768] + [1])
+    source = image.pixbuf_to_pil(pixbuf)
+    scale = 1.0
+    if max_pixels is not None:
+        src_width, src_height = source.size
+        step = int((float(src_width * src_height) / max_pixels) ** 0.5)
+        if step > 1:
+            source = source.resize((max(src_width // step, 1),
+                max(src_height // step, 1)), Image.NEAREST)
+            scale = (float(src_width * src_height) /
+                (source.size[0] * source.size[1]))
+    hist_data = [int(n * scale) for n in source.histogram()[:768]]
+    maximum = max(hist_data + [1])
     y_scale = float(height - 6) / maximum
     r = [int(hist_data[n] * y_scale) for n in xrange(256)]
     g = [int(hist_data[n] * y_scale) for n in xrange(256, 512)]
     b = [int(hist_data[n] * y_scale) for n in xrange(512, 768)]
+    if numpy is not None:
+        im = _draw_graphs_numpy(r, g, b, height, fill)
+    else:
+        im = _draw_graphs(r, g, b, height, fill)
+    if text:
+        maxstr = 'max: ' + str(maximum)
+        draw = ImageDraw.Draw(im)
+        draw.rectangle((0, 0, len(maxstr) * 6 + 2, 10), fill=(30, 30, 30))
+        draw.text((2, 0), maxstr, fill=(255, 255, 255))
+    im = ImageOps.expand(im, 1, (80, 80, 80))
+    im = ImageOps.expand(im, 1, (0, 0, 0))
+    return image.pil_to_pixbuf(im)
+
+
+def _draw_graphs_numpy(r, g, b, height, fill):
+    """Return a PIL image with the filled graphs and outlines for the
+    (scaled) histogram values in the lists <r>, <g> and <b>. The image is
+    identical to the one drawn by _draw_graphs(), but all pixels are
+    computed at once with numpy.
+    """
+    levels = numpy.array([r, g, b])
+    # The y value (height above the bottom) of every row in the image.
+    y = (height - 5 - numpy.arange(height - 4))[:, numpy.newaxis]
+    above_bottom = y >= 1
+    canvas = numpy.empty((height - 4, 258, 3), numpy.uint8)
+    canvas.fill(30)
+    # Draw the filling colours
+    filled = above_bottom & (y <= levels.max(axis=0))
+    for channel in xrange(3):
+        canvas[:, 1:257, channel][filled] = 0
+        canvas[:, 1:257, channel][filled & (y <= levels[channel])] = fill
+    # Draw the outlines
+    for channel in xrange(3):
+        prev = levels[channel, :-1]
+        cur = levels[channel, 1:]
+        rising = above_bottom & (((prev < y) & (y <= cur)) |
+            ((y == cur) & (cur != 0)))
+        falling = above_bottom & (cur < y) & (y <= prev)
+        canvas[:, 2:257, channel][rising] = 255
+        canvas[:, 1:256, channel][falling] = 255
+    return Image.fromarray(canvas, 'RGB')
+
+
+def _draw_graphs(r, g, b, height, fill):
+    """Return a PIL image with the filled graphs and outlines for the
+    (scaled) histogram values in the lists <r>, <g> and <b>, drawn pixel
+    by pixel. This is used when numpy is not available.
+    """
+    im = Image.new('RGB', (258, height - 4), (30, 30, 30))
     im_data = im.getdata()
     # Draw the filling colours
     for x in xrange(256):
@@ -54,11 +120,4 @@ def draw_histogram(pixbuf, height=170, fill=170, text=True):
         for y in range(b[x] + 1, b[x-1] + 1):
             r_px, g_px, b_px = im_data.getpixel((x, height - 5 - y))
             im_data.putpixel((x, height - 5 - y), (r_px, g_px, 255))
-    if text:
-        maxstr = 'max: ' + str(maximum)
-        draw = ImageDraw.Draw(im)
-        draw.rectangle((0, 0, len(maxstr) * 6 + 2, 10), fill=(30, 30, 30))
-        draw.text((2, 0), maxstr, fill=(255, 255, 255))
-    im = ImageOps.expand(im, 1, (80, 80, 80))
-    im = ImageOps.expand(im, 1, (0, 0, 0))
-    return image.pil_to_pixbuf(im)
+    return im
@@ -54,10 +54,10 @@ class MagnifyingGlass:
         if self._window.displayed_double():
             if self._window.is_manga_mode:
                 r_source_pixbuf, l_source_pixbuf = \
-                    self._window.file_handler.get_pixbufs()
+                    self._window.file_handler.get_pixbufs(full_size=True)
             else:
                 l_source_pixbuf, r_source_pixbuf = \
-                    self._window.file_handler.get_pixbufs()
+                    self._window.file_handler.get_pixbufs(full_size=True)
             if hasattr(l_source_pixbuf, 'get_static_image'):
                 l_source_pixbuf = l_source_pixbuf.get_static_image()
             if hasattr(r_source_pixbuf, 'get_static_image'):
@@ -69,7 +69,8 @@ class MagnifyingGlass:
             self._add_subpixbuf(canvas, x, y, r_image_size, r_source_pixbuf,
                 l_image_size[0], left=False)
         else:
-            source_pixbuf = self._window.file_handler.get_pixbufs()
+            source_pixbuf = self._window.file_handler.get_pixbufs(
+                full_size=True)
             if hasattr(source_pixbuf, 'get_static_image'):
                 source_pixbuf = source_pixbuf.get_static_image()
             image_size = self._window.left_image.size_request()
@@ -2,6 +2,7 @@
 
 import os
 import gc
+import threading
 import urllib
 from xml.sax.saxutils import escape as xmlescape
 
@@ -10,20 +11,36 @@ import gobject
 import pango
 from PIL import Image
 from PIL import ImageDraw
+try: # Used for live updates of watched folders, if available.
+    import pyinotify
+except ImportError:
+    pyinotify = None
 
 import archive
 import encoding
 import filechooser
 import labels
 import librarybackend
+import pixbufcache
 from preferences import prefs
 import image
+import thumbpack
 
 _dialog = None
 # The "All books" collection is not a real collection stored in the library,
 # but is represented by this ID in the library's TreeModels.
 _COLLECTION_ALL = -1
 _DRAG_EXTERNAL_ID, _DRAG_BOOK_ID, _DRAG_COLLECTION_ID = range(3)
+# The number of threads that load book covers.
+_LOADER_THREADS = 2
+# The maximum size in bytes of the covers kept in memory.
+_COVER_CACHE_SIZE = 32 * 1048576
+# The cover sizes of which covers are also stored on disk. Covers of the
+# sizes in between are only kept in memory.
+_PACKED_COVER_SIZES = (64, 80, 96, 112, 128)
+# The time in milliseconds to wait after a change in a watched folder
+# before it is scanned, so that a burst of changes is handled at once.
+_RESCAN_DELAY = 3000
 
 
 class _LibraryDialog(gtk.Window):
@@ -40,6 +57,12 @@ class _LibraryDialog(gtk.Window):
         
         self.filter_string = None
         self._file_handler = file_handler
+        self._closed = False
+        self._scanning = False
+        self._scan_again = False
+        self._notifier = None
+        self._notifier_watch = None
+        self._rescan_task = None
         self._statusbar = gtk.Statusbar()
         self._statusbar.set_has_resize_grip(True)
         self.backend = librarybackend.LibraryBackend()
@@ -57,6 +80,7 @@ class _LibraryDialog(gtk.Window):
         table.attach(self._statusbar, 0, 2, 2, 3, gtk.FILL, gtk.FILL)
         self.add(table)
         self.show_all()
+        self.update_watched_folders()
 
     def open_book(self, book):
         """Open the book with ID <book>."""
@@ -76,6 +100,8 @@ class _LibraryDialog(gtk.Window):
     def close(self, *args):
         """Close the library and do required cleanup tasks."""
         prefs['lib window width'], prefs['lib window height'] = self.get_size()
+        self._closed = True
+        self._stop_watching_folders()
         self.book_area.stop_update()
         self.backend.close()
         self.book_area.close()
@@ -101,6 +127,124 @@ class _LibraryDialog(gtk.Window):
             prefs['last library collection'] = collection
         self.collection_area.display_collections()
 
+    def update_watched_folders(self):
+        """Scan the watched folders for new, changed and removed books,
+        and keep watching them for changes while the library is open if
+        pyinotify is available. Should be called when the library is
+        opened and when the set of watched folders has changed.
+        """
+        self._stop_watching_folders()
+        folders = self.backend.get_watched_folders()
+        if not folders:
+            return
+        self.scan_watched_folders()
+        if pyinotify is None:
+            return
+        # Changes made over the network to a folder on a share are not
+        # reported by inotify. Those are found when the library is opened.
+        manager = pyinotify.WatchManager()
+        mask = (pyinotify.IN_CLOSE_WRITE | pyinotify.IN_CREATE |
+            pyinotify.IN_DELETE | pyinotify.IN_MOVED_FROM |
+            pyinotify.IN_MOVED_TO)
+        for folder in folders:
+            manager.add_watch(folder, mask, rec=True, auto_add=True,
+                quiet=True)
+        self._notifier = pyinotify.Notifier(manager, lambda event: None,
+            timeout=0)
+        self._notifier_watch = gobject.io_add_watch(manager.get_fd(),
+            gobject.IO_IN, self._folders_changed)
+
+    def scan_watched_folders(self):
+        """Scan the watched folders for new, changed and removed books in
+        a separate thread, and update the library with the result.
+        """
+        if self._scanning:
+            self._scan_again = True
+            return
+        self._scanning = True
+        self._scan_again = False
+        watched = self.backend.get_watched_books()
+        thread = threading.Thread(target=self._thread_scan, args=(watched,))
+        # The thread only reads the folders, so there is no need to wait
+        # for it (maybe on a slow share) when Comix is closed.
+        thread.setDaemon(True)
+        thread.start()
+
+    def _thread_scan(self, watched):
+        """Compare the files in the watched folders with the books in
+        <watched>, handing the result over to _scan_done(). Run in a
+        separate thread.
+        """
+        result = librarybackend.scan_watched_folders(watched)
+        gobject.idle_add(self._scan_done, *result)
+
+    def _scan_done(self, paths, books, stats):
+        """Update the library with the result of a scan of the watched
+        folders, where <paths> are the new or changed archives, <books>
+        the books that have been removed and <stats> the new stats of
+        unchanged books (see librarybackend.scan_watched_folders()).
+        """
+        if self._closed:
+            return False
+        self.backend.set_book_stats(stats)
+        if books:
+            choice_dialog = gtk.MessageDialog(self, 0, gtk.MESSAGE_QUESTION,
+                gtk.BUTTONS_YES_NO, _('Remove missing books from the library?'))
+            choice_dialog.format_secondary_text(
+                _('The files of %d book(s) in the watched folders no longer exist. Do you want to remove these books from the library and from their collections?') % len(books))
+            response = choice_dialog.run()
+            choice_dialog.destroy()
+            if self._closed:
+                return False
+            if response == gtk.RESPONSE_YES:
+                for book in books:
+                    self.backend.remove_book(book)
+                self.book_area.forget_covers(books)
+            else:
+                books = []
+        if paths:
+            self.add_books(paths)
+        elif books:
+            self.book_area.display_covers(
+                self.collection_area.get_current_collection())
+        if paths or books:
+            self.set_status_message(
+                _('Updated %(changed)d and removed %(removed)d book(s) in the watched folders.') %
+                {'changed': len(paths), 'removed': len(books)})
+        # Scans asked for while the books were being added are done now.
+        self._scanning = False
+        if self._scan_again:
+            self.scan_watched_folders()
+        return False
+
+    def _folders_changed(self, *args):
+        """Handle inotify events in the watched folders by scheduling a
+        scan of them.
+        """
+        self._notifier.read_events()
+        self._notifier.process_events()
+        if self._rescan_task is not None:
+            gobject.source_remove(self._rescan_task)
+        self._rescan_task = gobject.timeout_add(_RESCAN_DELAY, self._rescan)
+        return True
+
+    def _rescan(self):
+        """Scan the watched folders after they have changed."""
+        self._rescan_task = None
+        self.scan_watched_folders()
+        return False
+
+    def _stop_watching_folders(self):
+        """Stop watching the watched folders for changes."""
+        if self._rescan_task is not None:
+            gobject.source_remove(self._rescan_task)
+            self._rescan_task = None
+        if self._notifier is not None:
+            gobject.source_remove(self._notifier_watch)
+            self._notifier.stop()
+            self._notifier = None
+            self._notifier_watch = None
+
 
 class _CollectionArea(gtk.ScrolledWindow):
     
@@ -445,15 +589,30 @@ class _BookArea(gtk.ScrolledWindow):
     
     """The _BookArea is the central area in the library where the book
     covers are displayed.
+
+    When a collection is displayed the area is first filled with
+    placeholders. Only the covers of the books in view, or close to it,
+    are then loaded by a few threads, and covers that are scrolled far
+    out of view are replaced by placeholders again, so that the memory
+    used stays bounded however many books there are.
     """
     
     def __init__(self, library):
         gtk.ScrolledWindow.__init__(self)
         self._library = library
-        self._stop_update = False
+        self._covers = _CoverCache(library.backend)
+        self._placeholder = None
+        self._loaded = set() # Rows that show a real cover.
+        # Tuples (row, book, path, cover size) of covers left to load.
+        self._queue = []
+        self._queue_condition = threading.Condition()
+        self._loader_threads = 0
+        self._generation = 0
+        self._update_task = None
         self.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
         
-        self._liststore = gtk.ListStore(gtk.gdk.Pixbuf, int) # (Cover, ID).
+        # (Cover, ID, path).
+        self._liststore = gtk.ListStore(gtk.gdk.Pixbuf, int, str)
         self._iconview = gtk.IconView(self._liststore)
         self._iconview.set_pixbuf_column(0)
         self._iconview.connect('item_activated', self._book_activated)
@@ -472,6 +631,8 @@ class _BookArea(gtk.ScrolledWindow):
             gtk.gdk.ACTION_COPY | gtk.gdk.ACTION_MOVE)
         self._iconview.set_selection_mode(gtk.SELECTION_MULTIPLE)
         self.add(self._iconview)
+        self.get_vadjustment().connect('value-changed', self._schedule_update)
+        self.get_vadjustment().connect('changed', self._schedule_update)
 
         self._ui_manager = gtk.UIManager()
         ui_description = """
@@ -506,33 +667,55 @@ class _BookArea(gtk.ScrolledWindow):
         # We must (for some reason) explicitly clear the ListStore in
         # order to not leak memory.
         self._liststore.clear()
+        self._covers.close()
+
+    def forget_covers(self, books):
+        """Drop the stored covers of <books>, which have been removed from
+        the library.
+        """
+        for book in books:
+            self._covers.remove(book)
 
     def display_covers(self, collection):
         """Display the books in <collection> in the IconView."""
-        self._stop_update = False # To handle new re-entry during update.
+        self.stop_update()
         self._liststore.clear()
         if collection == _COLLECTION_ALL: # The "All" collection is virtual.
             collection = None
-        for i, book in enumerate(self._library.backend.get_books_in_collection(
-          collection, self._library.filter_string)):
-            self._add_book(book)
-            if i % 15 == 0: # Don't update GUI for every cover for efficiency.
-                while gtk.events_pending():
-                    gtk.main_iteration(False)
-                if self._stop_update:
-                    return
-        self._stop_update = True
+        books = self._library.backend.get_books_in_collection(collection,
+            self._library.filter_string)
+        fields = self._library.backend.get_books(books)
+        self._placeholder = _get_placeholder(prefs['library cover size'])
+        # Filling the ListStore is much faster while it is detached.
+        self._iconview.set_model(None)
+        for book in books:
+            self._liststore.append([self._placeholder, book,
+                fields[book]['path']])
+        self._iconview.set_model(self._liststore)
+        self._schedule_update()
+        return False
 
     def stop_update(self):
         """Signal that the updating of book covers should stop."""
-        self._stop_update = True
+        self._queue_condition.acquire()
+        self._generation += 1
+        del self._queue[:]
+        self._queue_condition.release()
+        self._loaded.clear()
+        if self._update_task is not None:
+            gobject.source_remove(self._update_task)
+            self._update_task = None
 
     def remove_book_at_path(self, path):
         """Remove the book at <path> from the ListStore (and thus from
         the _BookArea).
         """
         iterator = self._liststore.get_iter(path)
+        row = self._liststore.get_path(iterator)[0]
         self._liststore.remove(iterator)
+        self._loaded = set([loaded - (loaded > row)
+            for loaded in self._loaded if loaded != row])
+        self._schedule_update()
 
     def get_book_at_path(self, path):
         """Return the book ID corresponding to the IconView <path>."""
@@ -547,18 +730,85 @@ class _BookArea(gtk.ScrolledWindow):
         path = selected[0]
         self._book_activated(self._iconview, path)
 
-    def _add_book(self, book):
-        """Add the <book> to the ListStore (and thus to the _BookArea)."""
-        pixbuf = self._library.backend.get_book_cover(book)
+    def _schedule_update(self, *args):
+        """Update the covers to load once the IconView has settled."""
+        if self._update_task is None:
+            self._update_task = gobject.idle_add(self._update_covers)
+
+    def _update_covers(self):
+        """Queue the covers of the books in view, and those of the books
+        within a screen of them, to be loaded, with the ones in view
+        first. Replace covers far out of view with placeholders.
+        """
+        self._update_task = None
+        visible = self._iconview.get_visible_range()
+        if visible is None:
+            return False
+        first = visible[0][0]
+        last = visible[1][0]
+        screen = last - first + 1
+        for row in list(self._loaded):
+            if row < first - 3 * screen or row > last + 3 * screen:
+                self._liststore.set(self._liststore.get_iter(row), 0,
+                    self._placeholder)
+                self._loaded.discard(row)
+        rows = range(first, last + 1)
+        for distance in xrange(1, screen + 1):
+            rows.append(last + distance)
+            rows.append(first - distance)
+        size = prefs['library cover size']
+        queue = []
+        for row in rows:
+            if 0 <= row < len(self._liststore) and row not in self._loaded:
+                book, path = self._liststore.get(
+                    self._liststore.get_iter(row), 1, 2)
+                queue.append((row, book, path, size))
+        self._queue_condition.acquire()
+        self._queue[:] = queue
+        start = min(_LOADER_THREADS - self._loader_threads, len(queue))
+        self._loader_threads += start
+        self._queue_condition.release()
+        for i in xrange(start):
+            thread = threading.Thread(target=self._thread_load)
+            thread.setDaemon(False)
+            thread.start()
+        return False
+
+    def _thread_load(self):
+        """Load the covers in the queue until it is empty. The queue is
+        refilled when the displayed books change, and the threads then go
+        on with the new queue. This is run in separate threads, so the
+        covers are handed over to the main thread through idle callbacks.
+        """
+        while True:
+            self._queue_condition.acquire()
+            if not self._queue:
+                self._loader_threads -= 1
+                self._queue_condition.release()
+                return
+            generation = self._generation
+            row, book, path, size = self._queue.pop(0)
+            self._queue_condition.release()
+
+            pixbuf = self._covers.get(book, path, size)
+            gobject.idle_add(self._set_cover, generation, row, book, pixbuf)
+
+    def _set_cover(self, generation, row, book, pixbuf):
+        """Replace the placeholder for <book> at <row> with <pixbuf>, or
+        with a missing image icon if <pixbuf> is None.
+        """
+        if generation != self._generation or row >= len(self._liststore):
+            return False
+        iterator = self._liststore.get_iter(row)
+        if self._liststore.get_value(iterator, 1) != book:
+            return False
         if pixbuf is None:
-            pixbuf = self._library.render_icon(gtk.STOCK_MISSING_IMAGE,
-                gtk.ICON_SIZE_DIALOG)
-        # The ratio (0.67) is just above the normal aspect ratio for books.
-        pixbuf = image.fit_in_rectangle(pixbuf,
-            int(0.67 * prefs['library cover size']),
-            prefs['library cover size'])
-        pixbuf = image.add_border(pixbuf, 1, 0xFFFFFFFF)
-        self._liststore.append([pixbuf, book])
+            pixbuf = _finish_cover(self._library.render_icon(
+                gtk.STOCK_MISSING_IMAGE, gtk.ICON_SIZE_DIALOG),
+                prefs['library cover size'])
+        self._liststore.set(iterator, 0, pixbuf)
+        self._loaded.add(row)
+        return False
 
     def _book_activated(self, iconview, path):
         """Open the book at the (liststore) <path>."""
@@ -605,6 +855,7 @@ class _BookArea(gtk.ScrolledWindow):
             for path in selected:
                 book = self.get_book_at_path(path)
                 self._library.backend.remove_book(book)
+                self.forget_covers([book])
                 self.remove_book_at_path(path)
             self._library.set_status_message(
                 _('Removed %d book(s) from the library.') % len(selected))
@@ -800,6 +1051,13 @@ class _ControlArea(gtk.HBox):
         add_collection_button.set_tooltip_text(
             _('Add a new empty collection.'))
         hbox.pack_start(add_collection_button, False, False)
+        watched_button = gtk.Button(_('Watched folders'))
+        watched_button.connect('clicked', self._edit_watched_folders)
+        watched_button.set_image(gtk.image_new_from_stock(
+            gtk.STOCK_DIRECTORY, gtk.ICON_SIZE_BUTTON))
+        watched_button.set_tooltip_text(
+            _('Choose folders that are kept in sync with the library.'))
+        hbox.pack_start(watched_button, False, False)
         hbox.pack_start(gtk.HBox(), True, True)
         self._open_button = gtk.Button(None, gtk.STOCK_OPEN)
         self._open_button.connect('clicked',
@@ -815,12 +1073,14 @@ class _ControlArea(gtk.HBox):
         self._open_button.set_sensitive(False)
         if selected:
             book = self._library.book_area.get_book_at_path(selected[0])
-            name = self._library.backend.get_book_name(book)
-            dir_path = os.path.dirname(
-                self._library.backend.get_book_path(book))
-            format = self._library.backend.get_book_format(book)
-            pages = self._library.backend.get_book_pages(book)
-            size = self._library.backend.get_book_size(book)
+            fields = self._library.backend.get_books([book]).get(book, {})
+            name = fields.get('name')
+            dir_path = fields.get('path')
+            if dir_path is not None:
+                dir_path = os.path.dirname(dir_path)
+            format = fields.get('format')
+            pages = fields.get('pages')
+            size = fields.get('size')
         else:
             name = dir_path = format = pages = size = None
         if len(selected) == 1:
@@ -849,6 +1109,10 @@ class _ControlArea(gtk.HBox):
         """
         filechooser.open_library_filechooser_dialog(self._library)
 
+    def _edit_watched_folders(self, *args):
+        """Open up a dialog where the watched folders can be changed."""
+        _WatchedFoldersDialog(self._library)
+
     def _add_collection(self, *args):
         """Add a new collection to the library, through a dialog."""
         add_dialog = gtk.MessageDialog(None, 0, gtk.MESSAGE_QUESTION,
@@ -944,26 +1208,267 @@ class _AddBooksProgressDialog(gtk.Dialog):
         main_box.pack_start(added_label, False, False)
         self.show_all()
 
-        total_paths = float(len(paths))
-        total_added = 0
-        for i, path in enumerate(paths):
-            if library.backend.add_book(path, collection):
-                total_added += 1
-                number_label.set_text('%d' % total_added)
-            added_label.set_text(_("Adding '%s'...") %
-                encoding.to_unicode(path))
-            bar.set_fraction((i + 1) / total_paths)
-            while gtk.events_pending():
-                gtk.main_iteration(False)
-            if self._destroy:
-                return
-        self._response()
+        # The books are examined (and their covers created) in parallel
+        # by worker processes, driven from a separate thread. The results
+        # are collected here and added to the library in batches, one
+        # transaction per batch.
+        self._library = library
+        self._collection = collection
+        self._number_label = number_label
+        self._added_label = added_label
+        self._bar = bar
+        self._total_paths = float(len(paths))
+        self._total_done = 0
+        self._total_added = 0
+        self._results = []
+        self._finished = False
+        self._lock = threading.Lock()
+        self._examined = librarybackend.examine_books(paths)
+        thread = threading.Thread(target=self._thread_examine)
+        thread.setDaemon(False)
+        thread.start()
+        gobject.timeout_add(200, self._add_results)
+        while not self._destroy:
+            gtk.main_iteration(True)
+
+    def _thread_examine(self):
+        """Wait for the books to be examined, handing over the results to
+        _add_results(). Run in a separate thread.
+        """
+        for result in self._examined:
+            self._lock.acquire()
+            self._results.append(result)
+            self._lock.release()
+        self._lock.acquire()
+        self._finished = True
+        self._lock.release()
+
+    def _add_results(self):
+        """Add the books examined since the last call to the library and
+        update the progress. Called regularly in the main thread until all
+        books are done.
+        """
+        if self._destroy:
+            return False
+        self._lock.acquire()
+        results = self._results
+        self._results = []
+        finished = self._finished
+        self._lock.release()
+        if results:
+            self._total_added += self._library.backend.add_books(results,
+                self._collection)
+            self._total_done += len(results)
+            self._number_label.set_text('%d' % self._total_added)
+            self._added_label.set_text(_("Adding '%s'...") %
+                encoding.to_unicode(results[-1][0]))
+            self._bar.set_fraction(self._total_done / self._total_paths)
+        if finished:
+            self._response()
+            return False
+        return True
 
     def _response(self, *args):
         self._destroy = True
+        self._examined.close()
         self.destroy()
         
 
+class _CoverCache:
+
+    """A cache of book covers as they are displayed in the _BookArea, i.e.
+    scaled and with a border, for every cover size. The covers most
+    recently used are kept in memory, and covers of the sizes in
+    _PACKED_COVER_SIZES are also stored in one pack per size on disk
+    (see thumbpack.py), so that they need only be scaled once.
+
+    Covers are stamped with the modification times of the book and of the
+    stored cover thumbnail they were scaled from (see
+    LibraryBackend.get_book_cover_stamp()), so that they are made anew
+    when the book or its cover changes, or when a book ID is reused.
+
+    The cache may be used from several threads at once.
+    """
+
+    def __init__(self, backend):
+        self._backend = backend
+        self._memory = pixbufcache.PixbufCache(_COVER_CACHE_SIZE)
+        self._packs = {} # size: thumbpack.CoverPack
+        self._lock = threading.Lock()
+        self._closed = False
+        thumbpack.remove_cover_packs(_PACKED_COVER_SIZES)
+
+    def get(self, book, path, size):
+        """Return the cover of <book>, stored at <path>, for a cover size
+        of <size>, or None if there is no cover for the book.
+        """
+        stamp = self._backend.get_book_cover_stamp(path)
+        if stamp is not None:
+            key = (book, size, stamp)
+            pixbuf = self._memory.get(key)
+            if pixbuf is not None:
+                return pixbuf
+            pack = self._get_pack(size)
+            if pack is not None:
+                pixbuf = pack.get(book, stamp)
+                if pixbuf is not None:
+                    self._memory.put(key, pixbuf)
+                    return pixbuf
+        pixbuf = self._backend.get_book_cover(book, path)
+        if pixbuf is None:
+            return None
+        pixbuf = _finish_cover(pixbuf, size)
+        # The cover may have been created just now.
+        stamp = self._backend.get_book_cover_stamp(path)
+        if stamp is not None:
+            self._memory.put((book, size, stamp), pixbuf)
+            pack = self._get_pack(size)
+            if pack is not None:
+                pack.put(book, pixbuf, stamp)
+        return pixbuf
+
+    def remove(self, book):
+        """Remove the covers of <book>, which has been removed from the
+        library, from the packs on disk.
+        """
+        for size in _PACKED_COVER_SIZES:
+            pack = self._get_pack(size)
+            if pack is not None:
+                pack.remove(book)
+
+    def close(self):
+        """Close the packs on disk and empty the cache. Covers made after
+        this are no longer stored.
+        """
+        self._lock.acquire()
+        try:
+            self._closed = True
+            for pack in self._packs.itervalues():
+                pack.close()
+        finally:
+            self._lock.release()
+        self._memory.clear()
+
+    def _get_pack(self, size):
+        """Return the pack of covers of <size>, or None if covers of that
+        size are not stored on disk.
+        """
+        if size not in _PACKED_COVER_SIZES:
+            return None
+        self._lock.acquire()
+        try:
+            if size not in self._packs:
+                self._packs[size] = thumbpack.CoverPack(size)
+                if self._closed:
+                    self._packs[size].close()
+            return self._packs[size]
+        finally:
+            self._lock.release()
+
+
+class _WatchedFoldersDialog(gtk.Dialog):
+
+    """Dialog where the folders that the library watches for new, changed
+    and removed books are chosen.
+    """
+
+    def __init__(self, library):
+        gtk.Dialog.__init__(self, _('Watched folders'), library,
+            gtk.DIALOG_MODAL, (gtk.STOCK_CLOSE, gtk.RESPONSE_CLOSE))
+        self._library = library
+        self._changed = False
+        self.set_default_size(450, 300)
+        self.set_has_separator(False)
+        self.set_border_width(4)
+        self.connect('response', self._response)
+        self.set_default_response(gtk.RESPONSE_CLOSE)
+
+        main_box = gtk.VBox(False, 6)
+        main_box.set_border_width(6)
+        self.vbox.pack_start(main_box, True, True)
+        label = gtk.Label(_('The books in these folders and their subfolders are added to the library, and are updated or removed when their files change.'))
+        label.set_line_wrap(True)
+        label.set_alignment(0, 0.5)
+        main_box.pack_start(label, False, False)
+
+        self._liststore = gtk.ListStore(str, str) # (Displayed name, path).
+        treeview = gtk.TreeView(self._liststore)
+        treeview.set_headers_visible(False)
+        treeview.append_column(gtk.TreeViewColumn(None,
+            gtk.CellRendererText(), text=0))
+        self._selection = treeview.get_selection()
+        for folder in self._library.backend.get_watched_folders():
+            self._liststore.append([encoding.to_unicode(folder), folder])
+        scrolled = gtk.ScrolledWindow()
+        scrolled.set_policy(gtk.POLICY_AUTOMATIC, gtk.POLICY_AUTOMATIC)
+        scrolled.set_shadow_type(gtk.SHADOW_IN)
+        scrolled.add(treeview)
+        main_box.pack_start(scrolled, True, True)
+
+        hbox = gtk.HBox(False, 6)
+        main_box.pack_start(hbox, False, False)
+        add_button = gtk.Button(None, gtk.STOCK_ADD)
+        add_button.connect('clicked', self._add_folder)
+        hbox.pack_start(add_button, False, False)
+        remove_button = gtk.Button(None, gtk.STOCK_REMOVE)
+        remove_button.connect('clicked', self._remove_folder)
+        remove_button.set_tooltip_text(
+            _('Stop watching the selected folder. Its books are kept in the library.'))
+        hbox.pack_start(remove_button, False, False)
+        self.show_all()
+
+    def _add_folder(self, *args):
+        """Add a folder, chosen in a filechooser dialog, to the watched
+        folders.
+        """
+        dialog = gtk.FileChooserDialog(_('Watch folder'), self,
+            gtk.FILE_CHOOSER_ACTION_SELECT_FOLDER,
+            (gtk.STOCK_CANCEL, gtk.RESPONSE_CANCEL,
+            gtk.STOCK_ADD, gtk.RESPONSE_OK))
+        dialog.set_default_response(gtk.RESPONSE_OK)
+        if dialog.run() == gtk.RESPONSE_OK:
+            folder = dialog.get_filename()
+            if (folder and folder not in [row[1] for row in self._liststore]
+              and self._library.backend.add_watched_folder(folder)):
+                self._liststore.append([encoding.to_unicode(folder), folder])
+                self._changed = True
+        dialog.destroy()
+
+    def _remove_folder(self, *args):
+        """Remove the selected folder from the watched folders."""
+        model, iterator = self._selection.get_selected()
+        if iterator is None:
+            return
+        self._library.backend.remove_watched_folder(
+            model.get_value(iterator, 1))
+        model.remove(iterator)
+        self._changed = True
+
+    def _response(self, *args):
+        self.destroy()
+        if self._changed:
+            self._library.update_watched_folders()
+
+
+def _get_placeholder(size):
+    """Return a pixbuf to show in place of a book cover of <size> that has
+    not been loaded yet.
+    """
+    pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8,
+        max(1, int(0.67 * size)), size)
+    pixbuf.fill(0x333333ff)
+    return image.add_border(pixbuf, 1, 0x555555ff)
+
+
+def _finish_cover(pixbuf, size):
+    """Return the cover <pixbuf> as it should be displayed with a cover
+    size of <size>.
+    """
+    # The ratio (0.67) is just above the normal aspect ratio for books.
+    pixbuf = image.fit_in_rectangle(pixbuf, int(0.67 * size), size)
+    return image.add_border(pixbuf, 1, 0xFFFFFFFF)
+
+
 def open_dialog(action, window):
     global _dialog
     if _dialog is None:
@@ -1,6 +1,7 @@
 """librarybackend.py - Comic book library backend using sqlite."""
 
 import os
+import zlib
 try:
     from sqlite3 import dbapi2
 except ImportError:
@@ -13,10 +14,18 @@ except ImportError:
 import archive
 import constants
 import encoding
+import process
 import thumbnail
 
 _db_path = os.path.join(constants.DATA_DIR, 'library.db')
 _cover_dir = os.path.join(constants.DATA_DIR, 'library_covers')
+# The number of books fetched per query by LibraryBackend.get_books().
+_BULK_SIZE = 500
+# Maps the paths of files that were found not to be books (i.e. they are
+# not archives, or could not be added to the library) to their (size,
+# mtime, inode) at the time, so that scan_watched_folders() does not look
+# at them again as long as they are unchanged.
+_not_books = {}
 
 
 class LibraryBackend:
@@ -44,47 +53,99 @@ class LibraryBackend:
             self._create_table_collection()
         if not self._con.execute('pragma table_info(Contain)').fetchall():
             self._create_table_contain()
+        if not self._con.execute(
+          'pragma table_info(WatchedFolder)').fetchall():
+            self._create_table_watched_folder()
+        self._add_book_stat_columns()
+        self._create_indexes()
+        if not self._con.execute('pragma table_info(BookSearch)').fetchall():
+            self._create_table_book_search()
+        self._has_book_search = bool(self._con.execute(
+            'pragma table_info(BookSearch)').fetchall())
+        self._con.commit()
 
     def get_books_in_collection(self, collection=None, filter_string=None):
         """Return a sequence with all the books in <collection>, or *ALL*
         books if <collection> is None. If <filter_string> is not None, we
         only return books where the <filter_string> occurs in the path.
         """
-        if collection is None:
-            if filter_string is None:
-                cur = self._con.execute('''select id from Book
-                    order by path''')
-            else:
-                cur = self._con.execute('''select id from Book
-                    where path like ?
-                    order by path''', ("%%%s%%" % filter_string,))
-        else:
-            if filter_string is None:
-                cur = self._con.execute('''select id from Book
-                    where id in (select book from Contain where collection = ?)
-                    order by path''', (collection,))
+        tables = 'Book'
+        conditions = []
+        args = []
+        if collection is not None:
+            tables += ' join Contain on Contain.book = Book.id'
+            conditions.append('Contain.collection = ?')
+            args.append(collection)
+        if filter_string is not None:
+            # The trigram index can only be used for substrings of at
+            # least three characters.
+            if (self._has_book_search and
+              len(encoding.to_unicode(filter_string)) >= 3):
+                tables += ' join BookSearch on BookSearch.rowid = Book.id'
+                conditions.append('BookSearch match ?')
+                args.append('"%s"' % filter_string.replace('"', '""'))
             else:
-                cur = self._con.execute('''select id from Book
-                    where id in (select book from Contain where collection = ?)
-                    and path like ?
-                    order by path''', (collection, "%%%s%%" % filter_string))
+                conditions.append('Book.path like ?')
+                args.append('%%%s%%' % filter_string)
+        query = 'select Book.id from %s' % tables
+        if conditions:
+            query += ' where %s' % ' and '.join(conditions)
+        cur = self._con.execute(query + ' order by Book.path', args)
         return cur.fetchall()
 
-    def get_book_cover(self, book):
+    def get_books(self, books):
+        """Return a dictionary that maps each of the IDs in <books> to a
+        dictionary with all the fields of that book (id, name, path,
+        pages, format, size, added, mtime and inode). Books that aren't
+        in the library are left out.
+        """
+        books = list(books)
+        query = '''select * from Book where id in (%s)''' % ', '.join(
+            ['?'] * _BULK_SIZE)
+        fields = {}
+        for start in xrange(0, len(books), _BULK_SIZE):
+            # The chunks are padded to the same length so that the query
+            # text, and thereby the prepared statement cached by the
+            # connection, stays the same.
+            chunk = books[start:start + _BULK_SIZE]
+            chunk += [None] * (_BULK_SIZE - len(chunk))
+            cur = self._con.execute(query, chunk)
+            columns = [description[0] for description in cur.description]
+            for row in cur:
+                fields[row[0]] = dict(zip(columns, row))
+        return fields
+
+    def get_book_cover(self, book, path=None):
         """Return a pixbuf with a thumbnail of the cover of <book>, or
-        None if the cover can not be fetched.
+        None if the cover can not be fetched. If <path> is given it is
+        the path to <book>, as returned by get_books(), and the library
+        is not queried.
         """
-        try:
-            path = self._con.execute('''select path from Book
-                where id = ?''', (book,)).fetchone()
-        except Exception:
-            print '! Non-existant book #%d' % book
-            return None
+        if path is None:
+            path = self.get_book_path(book)
+            if path is None:
+                print '! Non-existant book #%d' % book
+                return None
         thumb = thumbnail.get_thumbnail(path, create=True, dst_dir=_cover_dir)
         if thumb is None:
             print '! Could not get cover for %s' % path
         return thumb
 
+    def get_book_cover_stamp(self, path):
+        """Return a stamp, as an unsigned 32-bit integer, made from the
+        modification times of the book at <path> and of its stored cover.
+        It changes whenever the book is changed (which makes the stored
+        cover out of date) or the cover is recreated. Return None if the
+        book or its cover does not exist. The library is not queried.
+        """
+        try:
+            book_mtime = int(os.stat(path).st_mtime)
+            cover_mtime = int(os.stat(thumbnail.get_thumbnail_path(path,
+                _cover_dir)).st_mtime)
+        except OSError:
+            return None
+        return zlib.crc32('%d %d' % (book_mtime, cover_mtime)) & 0xffffffff
+
     def get_book_path(self, book):
         """Return the filesystem path to <book>, or None if <book> isn't
         in the library.
@@ -182,33 +243,107 @@ class LibraryBackend:
         Return True if the book was successfully added (or was already
         added).
         """
-        path = os.path.abspath(path)
-        name = os.path.basename(path)
-        info = archive.get_archive_info(path)
-        if info is None:
-            return False
-        format, pages, size = info
-        thumbnail.get_thumbnail(path, create=True, dst_dir=_cover_dir)
-        old = self._con.execute('''select id from Book
-            where path = ?''', (path,)).fetchone()
+        return self.add_books([_examine_book(path)], collection) == 1
+
+    def add_books(self, books, collection=None):
+        """Add the books in <books> to the library in a single transaction,
+        where <books> is a sequence of tuples (path, info) as yielded by
+        examine_books(). Books with an info of None are skipped. If
+        <collection> is not None, it is the collection that the books
+        should be put in. Return the number of books that were
+        successfully added (or were already added).
+        """
+        rows = []
+        for path, info in books:
+            if info is not None:
+                rows.append((os.path.basename(path),) + tuple(info) +
+                    (path,))
+                _not_books.pop(path, None)
+                continue
+            try:
+                stat = os.stat(path)
+                _not_books[path] = (stat.st_size, int(stat.st_mtime),
+                    stat.st_ino)
+            except OSError:
+                pass
+        if not rows:
+            return 0
         try:
-            if old is not None:
-                self._con.execute('''update Book set
-                    name = ?, pages = ?, format = ?, size = ?
-                    where path = ?''', (name, pages, format, size, path))
-            else:
-                self._con.execute('''insert into Book
-                    (name, path, pages, format, size)
-                    values (?, ?, ?, ?, ?)''',
-                    (name, path, pages, format, size))
+            # Books already in the library keep their IDs, and thereby
+            # their collections, so they are updated rather than replaced.
+            self._con.executemany('''update Book set
+                name = ?, format = ?, pages = ?, size = ?, mtime = ?,
+                inode = ?
+                where path = ?''', rows)
+            self._con.executemany('''insert or ignore into Book
+                (name, format, pages, size, mtime, inode, path)
+                values (?, ?, ?, ?, ?, ?, ?)''', rows)
+            if collection is not None:
+                self._con.executemany('''insert or ignore into Contain
+                    (collection, book)
+                    select ?, id from Book where path = ?''',
+                    [(collection, row[-1]) for row in rows])
+            self._con.commit()
         except dbapi2.Error:
-            print '! Could not add book %s to the library' % path
-            return False
-        if collection is not None:
-            book = self._con.execute('''select id from Book
-                where path = ?''', (path,)).fetchone()
-            self.add_book_to_collection(book, collection)
-        return True
+            self._con.rollback()
+            print '! Could not add books to the library'
+            return 0
+        return len(rows)
+
+    def set_book_stats(self, stats):
+        """Set the size, modification time and inode of books, where
+        <stats> is a sequence of tuples (size, mtime, inode, path) as
+        returned by scan_watched_folders().
+        """
+        try:
+            self._con.executemany('''update Book set
+                size = ?, mtime = ?, inode = ?
+                where path = ?''', stats)
+            self._con.commit()
+        except dbapi2.Error:
+            self._con.rollback()
+            print '! Could not update books in the library'
+
+    def get_watched_folders(self):
+        """Return a sequence with the paths of all watched folders."""
+        cur = self._con.execute('''select path from WatchedFolder
+            order by path''')
+        return cur.fetchall()
+
+    def get_watched_books(self):
+        """Return a dictionary that maps each watched folder to a
+        dictionary, which maps the paths of the books in the folder (or
+        its subfolders) to tuples (book, size, mtime, inode). This is
+        what scan_watched_folders() compares the files on disk with.
+        """
+        watched = {}
+        for folder in self.get_watched_folders():
+            # The paths in the folder sort between the folder path with a
+            # trailing separator and the same with the next character in
+            # its place, so the index on Book(path) can be used.
+            prefix = os.path.join(folder, '')
+            cur = self._con.execute('''select path, id, size, mtime, inode
+                from Book where path >= ? and path < ?''',
+                (prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)))
+            watched[folder] = dict([(row[0], row[1:]) for row in cur])
+        return watched
+
+    def add_watched_folder(self, path):
+        """Watch the folder at <path> for books. Return True if the folder
+        was successfully added (or was already watched).
+        """
+        try:
+            self._con.execute('''insert or ignore into WatchedFolder
+                (path) values (?)''', (os.path.abspath(path),))
+            return True
+        except dbapi2.Error:
+            print '! Could not watch folder %s' % path
+        return False
+
+    def remove_watched_folder(self, path):
+        """Stop watching the folder at <path>. The books in it are kept."""
+        self._con.execute('''delete from WatchedFolder
+            where path = ?''', (path,))
 
     def add_collection(self, name):
         """Add a new collection with <name> to the library. Return True
@@ -314,7 +449,9 @@ class LibraryBackend:
             pages integer,
             format integer,
             size integer,
-            added date default current_date)''')
+            added date default current_date,
+            mtime integer,
+            inode integer)''')
 
     def _create_table_collection(self):
         self._con.execute('''create table collection (
@@ -327,3 +464,177 @@ class LibraryBackend:
             collection integer not null,
             book integer not null,
             primary key (collection, book))''')
+
+    def _create_table_watched_folder(self):
+        self._con.execute('''create table watchedfolder (
+            path string primary key)''')
+
+    def _add_book_stat_columns(self):
+        """Add the mtime and inode columns to Book tables created before
+        they were used. Books without them are treated as changed by the
+        next scan, unless their size matches (see scan_watched_folders()).
+        """
+        columns = [info[1] for info in
+            self._con.execute('pragma table_info(Book)').fetchall()]
+        for column in ('mtime', 'inode'):
+            if column not in columns:
+                self._con.execute('''alter table Book
+                    add column %s integer''' % column)
+
+    def _create_indexes(self):
+        """Create the secondary indexes, unless they exist already. The
+        name of a collection is indexed by its unique constraint.
+        """
+        self._con.execute('''create index if not exists contain_book
+            on Contain (book)''')
+        self._con.execute('''create index if not exists
+            collection_supercollection
+            on Collection (supercollection)''')
+
+    def _create_table_book_search(self):
+        """Create a full text index with the trigrams of the book paths,
+        used to filter books by substrings of their paths, and the
+        triggers that keep it in sync with the Book table. Nothing is
+        created if the SQLite library lacks FTS5 or its trigram tokenizer
+        (SQLite < 3.34), and filtering falls back to scanning the paths.
+        """
+        try:
+            self._con.execute('''create virtual table BookSearch
+                using fts5(path, content='Book', content_rowid='id',
+                tokenize='trigram')''')
+        except dbapi2.Error:
+            return
+        self._con.execute('''create trigger book_search_insert
+            after insert on Book begin
+                insert into BookSearch (rowid, path)
+                values (new.id, new.path);
+            end''')
+        self._con.execute('''create trigger book_search_delete
+            after delete on Book begin
+                insert into BookSearch (BookSearch, rowid, path)
+                values ('delete', old.id, old.path);
+            end''')
+        self._con.execute('''create trigger book_search_update
+            after update of path on Book begin
+                insert into BookSearch (BookSearch, rowid, path)
+                values ('delete', old.id, old.path);
+                insert into BookSearch (rowid, path)
+                values (new.id, new.path);
+            end''')
+        self._con.execute('''insert into BookSearch (BookSearch)
+            values ('rebuild')''')
+
+
+def examine_books(paths):
+    """Read the archive info (see archive.get_archive_info()) of the books
+    at <paths> and create their covers, in parallel in a pool of worker
+    processes. Return an iterator (see process.map_unordered()) that
+    yields a tuple (path, info) for each book as soon as it is done,
+    where <path> is the absolute path and <info> is a tuple (mime,
+    num_pages, size, mtime, inode), or None if the book could not be
+    read. The results can be passed on to LibraryBackend.add_books().
+
+    This does not touch the library database, so the iterator may be
+    used in another thread than the one that owns the LibraryBackend.
+    """
+    return process.map_unordered(_examine_book, paths)
+
+
+def scan_watched_folders(watched):
+    """Compare the files in the watched folders with the books in them, as
+    given by <watched> (see LibraryBackend.get_watched_books()). Return a
+    tuple (paths, books, stats) where <paths> is a list of the archives
+    that are new or have changed, to be examined by examine_books(),
+    <books> is a list of the books whose files have been removed, and
+    <stats> is a list of new stats for LibraryBackend.set_book_stats().
+
+    Files are compared by their size, modification time and inode, so
+    only new and changed files are opened. Books added before their
+    modification times were stored are assumed to be unchanged if their
+    size matches, and only get their stats recorded. Files that were found
+    not to be books, by an earlier scan or by add_books(), are skipped in
+    the same way as long as they are unchanged.
+
+    A folder is skipped entirely if any part of it can not be read, and
+    books are never reported as removed from a folder in which no files
+    are found at all, since that is what an unmounted share (which
+    leaves its empty mount point behind) looks like. Books whose files
+    are listed but can not be stat'ed are kept as they are.
+
+    Like examine_books(), this may be run in another thread.
+    """
+    paths = []
+    books = []
+    stats = []
+    for folder, stored in watched.iteritems():
+        if not os.path.isdir(folder):
+            continue
+        # The books in a folder within another watched folder are also in
+        # that folder, so they are compared only once.
+        for other in watched:
+            if folder.startswith(os.path.join(other, '')):
+                break
+        else:
+            other = None
+        if other is not None:
+            continue
+        errors = []
+        folder_paths = []
+        folder_stats = []
+        folder_not_books = {}
+        found = False
+        for dirpath, dirnames, filenames in os.walk(folder,
+          onerror=errors.append):
+            for name in filenames:
+                found = True
+                path = os.path.join(dirpath, name)
+                book = stored.pop(path, None)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                current = (stat.st_size, int(stat.st_mtime), stat.st_ino)
+                if book is None:
+                    if _not_books.get(path) == current:
+                        folder_not_books[path] = current
+                    elif archive.archive_mime_type(path) is not None:
+                        folder_paths.append(path)
+                    else:
+                        folder_not_books[path] = current
+                elif book[2] is None and book[1] == stat.st_size:
+                    folder_stats.append(current + (path,))
+                elif book[1:] != current:
+                    folder_paths.append(path)
+        if errors:
+            print '! Could not scan watched folder %s' % folder
+            continue
+        paths.extend(folder_paths)
+        stats.extend(folder_stats)
+        # Files that are gone are forgotten.
+        prefix = os.path.join(folder, '')
+        for path in _not_books.keys():
+            if path.startswith(prefix) and path not in folder_not_books:
+                del _not_books[path]
+        _not_books.update(folder_not_books)
+        if found:
+            books.extend([book[0] for book in stored.itervalues()])
+    return paths, books, stats
+
+
+def _examine_book(path):
+    """Return a tuple (path, info) for the book at <path> and create its
+    cover. This is run in the worker processes of examine_books().
+    """
+    path = os.path.abspath(path)
+    try:
+        # The file is stat'ed first, so that if it changes while it is
+        # being read it is seen as changed by the next scan.
+        stat = os.stat(path)
+        info = archive.get_archive_info(path)
+        if info is not None:
+            thumbnail.get_thumbnail(path, create=True, dst_dir=_cover_dir)
+            info = (info[0], info[1], stat.st_size, int(stat.st_mtime),
+                stat.st_ino)
+    except Exception:
+        info = None
+    return path, info
@@ -16,13 +16,21 @@ import event
 import filehandler
 import image
 import lens
+import pixbufcache
 import preferences
 from preferences import prefs
+import profiler
 import ui
 import slideshow
 import status
 import thumbbar
 
+# Memory limit (in bytes) for scaled and enhanced pixbufs ready for display.
+_RENDER_CACHE_SIZE = 64 * 1048576
+# The number of times (50 ms apart) to look for the decoded next page(s)
+# before giving up on rendering them in advance.
+_PRERENDER_TRIES = 40
+
 
 class MainWindow(gtk.Window):
 
@@ -47,6 +55,12 @@ class MainWindow(gtk.Window):
 
         self._manual_zoom = 100 # In percent of original image size
         self._waiting_for_redraw = False
+        self._redraw_preview = False
+        self._render_cache = pixbufcache.PixbufCache(_RENDER_CACHE_SIZE)
+        self._prerender_source = None
+        self._prerender_tries = 0
+        # (page index, enhancement, checkered bg): smart bg colour
+        self._bg_colours = {}
 
         self.file_handler = filehandler.FileHandler(self)
         self.thumbnailsidebar = thumbbar.ThumbnailSidebar(self)
@@ -194,33 +208,35 @@ class MainWindow(gtk.Window):
         if show_library:
             self.actiongroup.get_action('library').activate()
 
-    def draw_image(self, at_bottom=False, scroll=True):
+    def draw_image(self, at_bottom=False, scroll=True, preview=False):
         """Draw the current page(s) and update the titlebar and statusbar.
+
+        If <preview> is True the pages are scaled with a fast, low quality
+        method, e.g. while the window is being resized. The caller must
+        then make sure that a normal redraw follows.
         """
-        if not self._waiting_for_redraw: # Don't stack up redraws.
-            self._waiting_for_redraw = True
-            gobject.idle_add(self._draw_image, at_bottom, scroll,
-                priority=gobject.PRIORITY_HIGH_IDLE)
+        if self._waiting_for_redraw: # Don't stack up redraws.
+            self._redraw_preview = self._redraw_preview and preview
+            return
+        self._waiting_for_redraw = True
+        self._redraw_preview = preview
+        gobject.idle_add(self._draw_image, at_bottom, scroll,
+            priority=gobject.PRIORITY_HIGH_IDLE)
 
     def _draw_image(self, at_bottom, scroll):
         self._waiting_for_redraw = False
+        preview = self._redraw_preview
         self._display_active_widgets()
         if not self.file_handler.file_loaded:
             return False
+        profiler.begin_frame()
         area_width, area_height = self.get_visible_area_size()
-        if self.zoom_mode == preferences.ZOOM_MODE_HEIGHT:
-            scaled_width = -1
-        else:
-            scaled_width = area_width
-        if self.zoom_mode == preferences.ZOOM_MODE_WIDTH:
-            scaled_height = -1
-        else:
-            scaled_height = area_height
-        scale_up = prefs['stretch']
         self.is_virtual_double_page = \
             self.file_handler.get_virtual_double_page()
 
         if self.displayed_double():
+            left_index = self.file_handler.get_current_page() - 1
+            right_index = left_index + 1
             left_pixbuf, right_pixbuf = self.file_handler.get_pixbufs()
             if hasattr(left_pixbuf, 'get_static_image'):
                 left_pixbuf = left_pixbuf.get_static_image()
@@ -228,48 +244,15 @@ class MainWindow(gtk.Window):
                 right_pixbuf = right_pixbuf.get_static_image()
             if self.is_manga_mode:
                 right_pixbuf, left_pixbuf = left_pixbuf, right_pixbuf
-            left_unscaled_x = left_pixbuf.get_width()
-            left_unscaled_y = left_pixbuf.get_height()
-            right_unscaled_x = right_pixbuf.get_width()
-            right_unscaled_y = right_pixbuf.get_height()
-
-            left_rotation = prefs['rotation']
-            right_rotation = prefs['rotation']
-            if prefs['auto rotate from exif']:
-                left_rotation += image.get_implied_rotation(left_pixbuf)
-                left_rotation = left_rotation % 360
-                right_rotation += image.get_implied_rotation(right_pixbuf)
-                right_rotation = right_rotation % 360
-
-            if self.zoom_mode == preferences.ZOOM_MODE_MANUAL:
-                if left_rotation in (90, 270):
-                    total_width = left_unscaled_x
-                    total_height = left_unscaled_y
-                else:
-                    total_width = left_unscaled_y
-                    total_height = left_unscaled_x
-                if right_rotation in (90, 270):
-                    total_width += right_unscaled_x
-                    total_height += right_unscaled_y
-                else:
-                    total_width += right_unscaled_y
-                    total_height += right_unscaled_x
-                scaled_width = int(self._manual_zoom * total_width / 100)
-                scaled_height = int(self._manual_zoom * total_height / 100)
-                scale_up = True
-
-            left_pixbuf, right_pixbuf = image.fit_2_in_rectangle(
-                left_pixbuf, right_pixbuf, scaled_width, scaled_height,
-                scale_up=scale_up, rotation1=left_rotation,
-                rotation2=right_rotation)
-            if prefs['horizontal flip']:
-                left_pixbuf = left_pixbuf.flip(horizontal=True)
-                right_pixbuf = right_pixbuf.flip(horizontal=True)
-            if prefs['vertical flip']:
-                left_pixbuf = left_pixbuf.flip(horizontal=False)
-                right_pixbuf = right_pixbuf.flip(horizontal=False)
-            left_pixbuf = self.enhancer.enhance(left_pixbuf)
-            right_pixbuf = self.enhancer.enhance(right_pixbuf)
+                right_index, left_index = left_index, right_index
+            left_unscaled_x, left_unscaled_y = \
+                self.file_handler.get_full_size(left_index, left_pixbuf)
+            right_unscaled_x, right_unscaled_y = \
+                self.file_handler.get_full_size(right_index, right_pixbuf)
+
+            left_pixbuf, right_pixbuf, left_rotation, right_rotation = \
+                self._render_double(left_index, left_pixbuf, right_index,
+                right_pixbuf, area_width, area_height, preview)
 
             self.left_image.set_from_pixbuf(left_pixbuf)
             self.right_image.set_from_pixbuf(right_pixbuf)
@@ -297,38 +280,20 @@ class MainWindow(gtk.Window):
                 (left_unscaled_x, left_unscaled_y, left_scale_percent),
                 (right_unscaled_x, right_unscaled_y, right_scale_percent))
         else:
+            index = self.file_handler.get_current_page() - 1
             pixbuf = self.file_handler.get_pixbufs(single=True)
-            unscaled_x = pixbuf.get_width()
-            unscaled_y = pixbuf.get_height()
+            unscaled_x, unscaled_y = self.file_handler.get_full_size(index,
+                pixbuf)
 
-            rotation = prefs['rotation']
-            if prefs['auto rotate from exif']:
-                if hasattr(pixbuf, 'get_static_image'):
-                    rotation += image.get_implied_rotation(pixbuf.get_static_image())
-                else:
-                    rotation += image.get_implied_rotation(pixbuf)
-                rotation = rotation % 360
-
-            if self.zoom_mode == preferences.ZOOM_MODE_MANUAL:
-                scaled_width = int(self._manual_zoom * unscaled_x / 100)
-                scaled_height = int(self._manual_zoom * unscaled_y / 100)
-                if rotation in (90, 270):
-                    scaled_width, scaled_height = scaled_height, scaled_width
-                scale_up = True
-            
             if not hasattr(pixbuf, 'is_static_image') or pixbuf.is_static_image():
                 if hasattr(pixbuf, 'get_static_image'):
                     pixbuf = pixbuf.get_static_image()
-                pixbuf = image.fit_in_rectangle(pixbuf, scaled_width,
-                    scaled_height, scale_up=scale_up, rotation=rotation)
-                if prefs['horizontal flip']:
-                    pixbuf = pixbuf.flip(horizontal=True)
-                if prefs['vertical flip']:
-                    pixbuf = pixbuf.flip(horizontal=False)
-                pixbuf = self.enhancer.enhance(pixbuf)
+                pixbuf, rotation = self._render_single(index, pixbuf,
+                    area_width, area_height, preview)
 
                 self.left_image.set_from_pixbuf(pixbuf)
             else:
+                rotation = self._get_rotation(pixbuf.get_static_image())
                 self.left_image.set_from_animation(pixbuf)
             self.right_image.clear()
             x_padding = (area_width - pixbuf.get_width()) / 2
@@ -345,9 +310,21 @@ class MainWindow(gtk.Window):
                 scale_percent))
         
         if prefs['smart bg']:
-            bg_colour = image.get_most_common_edge_colour(
-                self.left_image.get_pixbuf())
+            start = profiler.clock()
+            # The colour is sampled from the rendered pixbuf, which may
+            # have a checkered background.
+            checkered = prefs['checkered bg for transparent images']
+            if self.displayed_double():
+                key = (left_index, self.enhancer.get_values(), checkered)
+            else:
+                key = (index, self.enhancer.get_values(), checkered)
+            bg_colour = self._bg_colours.get(key)
+            if bg_colour is None:
+                bg_colour = image.get_most_common_edge_colour(
+                    self.left_image.get_pixbuf())
+                self._bg_colours[key] = bg_colour
             self.set_bg_colour(bg_colour)
+            profiler.add('smart bg', start)
 
         self._image_box.window.freeze_updates()
         self._main_layout.move(self._image_box, max(0, x_padding),
@@ -369,11 +346,245 @@ class MainWindow(gtk.Window):
             self.file_handler.get_pretty_current_filename())
         self.statusbar.update()
         self.update_title()
+        if preview:
+            self._end_profiling()
+            return False
         while gtk.events_pending():
             gtk.main_iteration(False)
+        start = profiler.clock()
         enhance.draw_histogram(self.left_image)
+        profiler.add('histogram', start)
+        start = profiler.clock()
         self.file_handler.do_cacheing()
+        profiler.add('cacheing', start)
+        self._schedule_prerender()
+        start = profiler.clock()
         self.thumbnailsidebar.load_thumbnails()
+        profiler.add('thumbnails', start)
+        self._end_profiling()
+        return False
+
+    def _end_profiling(self):
+        """Finish profiling the current draw, if profiling is enabled, and
+        show the summary in the statusbar.
+        """
+        summary = profiler.end_frame(self.file_handler.get_current_page())
+        if summary is not None:
+            self.statusbar.set_profile(summary)
+            self.statusbar.update()
+
+    def _get_scaled_size(self, area_width, area_height):
+        """Return a tuple (width, height, scale_up) with the size that pages
+        should be fitted into in the current zoom mode (other than manual
+        zoom), given a visible area of <area_width>x<area_height>.
+        """
+        if self.zoom_mode == preferences.ZOOM_MODE_HEIGHT:
+            scaled_width = -1
+        else:
+            scaled_width = area_width
+        if self.zoom_mode == preferences.ZOOM_MODE_WIDTH:
+            scaled_height = -1
+        else:
+            scaled_height = area_height
+        return scaled_width, scaled_height, prefs['stretch']
+
+    def get_fit_box(self):
+        """Return a tuple (width, height, scale_up, rotation) with the
+        arguments that pages are currently passed to fit_in_rectangle()
+        with for display, or None if pages are displayed at manual zoom
+        (and thus might need their full size).
+        """
+        if self.zoom_mode == preferences.ZOOM_MODE_MANUAL:
+            return None
+        width, height, scale_up = self._get_scaled_size(
+            *self.get_visible_area_size())
+        return width, height, scale_up, prefs['rotation']
+
+    def _get_rotation(self, pixbuf):
+        """Return the rotation (in degrees) that <pixbuf> should be
+        displayed with.
+        """
+        rotation = prefs['rotation']
+        if prefs['auto rotate from exif']:
+            rotation += image.get_implied_rotation(pixbuf)
+            rotation = rotation % 360
+        return rotation
+
+    def _render_single(self, index, pixbuf, area_width, area_height,
+      preview=False):
+        """Return a tuple (pixbuf, rotation) with the static <pixbuf> for
+        page <index> scaled, rotated, flipped and enhanced for display in
+        an area of <area_width>x<area_height>.
+
+        Rendered pixbufs are cached, keyed by all the parameters used to
+        render them, so that redrawing a page is cheap. If <preview> is
+        True and the page is not in the cache, it is scaled with a fast
+        method and the result is not cached.
+        """
+        scaled_width, scaled_height, scale_up = self._get_scaled_size(
+            area_width, area_height)
+        rotation = self._get_rotation(pixbuf)
+        if self.zoom_mode == preferences.ZOOM_MODE_MANUAL:
+            scaled_width = int(self._manual_zoom * pixbuf.get_width() / 100)
+            scaled_height = int(self._manual_zoom * pixbuf.get_height() / 100)
+            if rotation in (90, 270):
+                scaled_width, scaled_height = scaled_height, scaled_width
+            scale_up = True
+
+        key = ('single', index, scaled_width, scaled_height, scale_up,
+            rotation, prefs['horizontal flip'], prefs['vertical flip'],
+            self.enhancer.get_values(),
+            prefs['checkered bg for transparent images'])
+        rendered = self._render_cache.get(key)
+        if rendered is None:
+            start = profiler.clock()
+            rendered = image.fit_in_rectangle(pixbuf, scaled_width,
+                scaled_height, scale_up=scale_up, rotation=rotation,
+                interp=_get_interpolation(preview))
+            if prefs['horizontal flip']:
+                rendered = rendered.flip(horizontal=True)
+            if prefs['vertical flip']:
+                rendered = rendered.flip(horizontal=False)
+            profiler.add('scale', start)
+            start = profiler.clock()
+            rendered = self.enhancer.enhance(rendered)
+            profiler.add('enhance', start)
+            if not preview:
+                self._render_cache.put(key, rendered)
+        return rendered, rotation
+
+    def _render_double(self, left_index, left_pixbuf, right_index,
+      right_pixbuf, area_width, area_height, preview=False):
+        """Return a tuple (left pixbuf, right pixbuf, left rotation, right
+        rotation) with the static <left_pixbuf> and <right_pixbuf> for the
+        pages <left_index> and <right_index> scaled, rotated, flipped and
+        enhanced for display side by side in an area of
+        <area_width>x<area_height>.
+
+        Rendered pixbufs are cached, and <preview> is handled, like in
+        _render_single().
+        """
+        scaled_width, scaled_height, scale_up = self._get_scaled_size(
+            area_width, area_height)
+        left_rotation = self._get_rotation(left_pixbuf)
+        right_rotation = self._get_rotation(right_pixbuf)
+        if self.zoom_mode == preferences.ZOOM_MODE_MANUAL:
+            if left_rotation in (90, 270):
+                total_width = left_pixbuf.get_width()
+                total_height = left_pixbuf.get_height()
+            else:
+                total_width = left_pixbuf.get_height()
+                total_height = left_pixbuf.get_width()
+            if right_rotation in (90, 270):
+                total_width += right_pixbuf.get_width()
+                total_height += right_pixbuf.get_height()
+            else:
+                total_width += right_pixbuf.get_height()
+                total_height += right_pixbuf.get_width()
+            scaled_width = int(self._manual_zoom * total_width / 100)
+            scaled_height = int(self._manual_zoom * total_height / 100)
+            scale_up = True
+
+        key = ('double', left_index, right_index, scaled_width,
+            scaled_height, scale_up, left_rotation, right_rotation,
+            prefs['horizontal flip'], prefs['vertical flip'],
+            self.enhancer.get_values(),
+            prefs['checkered bg for transparent images'])
+        left_rendered = self._render_cache.get((key, 'left'))
+        right_rendered = self._render_cache.get((key, 'right'))
+        if left_rendered is None or right_rendered is None:
+            start = profiler.clock()
+            left_rendered, right_rendered = image.fit_2_in_rectangle(
+                left_pixbuf, right_pixbuf, scaled_width, scaled_height,
+                scale_up=scale_up, rotation1=left_rotation,
+                rotation2=right_rotation, interp=_get_interpolation(preview))
+            if prefs['horizontal flip']:
+                left_rendered = left_rendered.flip(horizontal=True)
+                right_rendered = right_rendered.flip(horizontal=True)
+            if prefs['vertical flip']:
+                left_rendered = left_rendered.flip(horizontal=False)
+                right_rendered = right_rendered.flip(horizontal=False)
+            profiler.add('scale', start)
+            start = profiler.clock()
+            left_rendered = self.enhancer.enhance(left_rendered)
+            right_rendered = self.enhancer.enhance(right_rendered)
+            profiler.add('enhance', start)
+            if not preview:
+                self._render_cache.put((key, 'left'), left_rendered)
+                self._render_cache.put((key, 'right'), right_rendered)
+        return left_rendered, right_rendered, left_rotation, right_rotation
+
+    def _schedule_prerender(self):
+        """Schedule the page(s) following the current one to be rendered
+        into the render cache when the program is otherwise idle.
+        """
+        if self._prerender_source is not None:
+            gobject.source_remove(self._prerender_source)
+            self._prerender_source = None
+        # Without cacheing the next pages are never decoded in advance.
+        if not prefs['cache']:
+            return
+        self._prerender_tries = _PRERENDER_TRIES
+        self._prerender_source = gobject.timeout_add(50,
+            self._prerender_next_page, self.file_handler.get_current_page(),
+            priority=gobject.PRIORITY_LOW)
+
+    def _prerender_next_page(self, page):
+        """Render the page(s) that follow <page> at the current window size
+        into the render cache, so that flipping to them only means showing
+        ready pixbufs. Return True, to be called again, as long as the raw
+        pixbufs are still being decoded in the background, but give up
+        after _PRERENDER_TRIES calls (e.g. if they were evicted from the
+        cache before they could be rendered).
+        """
+        if (not self.file_handler.file_loaded or
+          page != self.file_handler.get_current_page()):
+            self._prerender_source = None
+            return False
+        step = 1
+        if self.displayed_double() and prefs['double step in double page mode']:
+            step = 2
+        index = page - 1 + step
+        number_of_pages = self.file_handler.get_number_of_pages()
+        indices = [i for i in (index, index + 1) if i < number_of_pages]
+        if not self.is_double_page or len(indices) < 2:
+            indices = indices[:1]
+        pixbufs = []
+        for i in indices:
+            pixbuf = self.file_handler.get_cached_pixbuf(i)
+            if pixbuf is None:
+                self._prerender_tries -= 1
+                if self._prerender_tries > 0:
+                    return True
+                self._prerender_source = None
+                return False
+            pixbufs.append(pixbuf)
+        self._prerender_source = None
+        if not pixbufs:
+            return False
+        if len(pixbufs) == 2 and prefs['no double page for wide images']:
+            for pixbuf in pixbufs:
+                if pixbuf.get_width() > pixbuf.get_height():
+                    del pixbufs[1:], indices[1:]
+                    break
+        if len(pixbufs) == 1 and hasattr(pixbufs[0], 'is_static_image') \
+          and not pixbufs[0].is_static_image():
+            return False
+        for i, pixbuf in enumerate(pixbufs):
+            if hasattr(pixbuf, 'get_static_image'):
+                pixbufs[i] = pixbuf.get_static_image()
+        area_width, area_height = self.get_visible_area_size()
+        if len(pixbufs) == 2:
+            left_index, right_index = indices
+            left_pixbuf, right_pixbuf = pixbufs
+            if self.is_manga_mode:
+                right_pixbuf, left_pixbuf = left_pixbuf, right_pixbuf
+                right_index, left_index = left_index, right_index
+            self._render_double(left_index, left_pixbuf, right_index,
+                right_pixbuf, area_width, area_height)
+        else:
+            self._render_single(indices[0], pixbufs[0], area_width,
+                area_height)
         return False
 
     def new_page(self, at_bottom=False):
@@ -650,6 +861,8 @@ class MainWindow(gtk.Window):
         """Clear the currently displayed data (i.e. "close" the file)."""
         self.left_image.clear()
         self.right_image.clear()
+        self._render_cache.clear()
+        self._bg_colours.clear()
         self.thumbnailsidebar.clear()
         self.set_title('Comix')
         self.statusbar.set_message('')
@@ -786,6 +999,7 @@ class MainWindow(gtk.Window):
             prefs['path to last file'] = ''
             prefs['page of last file'] = 1
         self.file_handler.cleanup()
+        profiler.finish()
         preferences.write_preferences_file()
         self.ui_manager.bookmarks.write_bookmarks_file()
         # This hack is to avoid Python issue #1856.
@@ -794,3 +1008,12 @@ class MainWindow(gtk.Window):
                 thread.join()
         print 'Bye!'
         sys.exit(0)
+
+
+def _get_interpolation(preview):
+    """Return the interpolation type to scale pages with, depending on
+    whether a fast <preview> is wanted.
+    """
+    if preview:
+        return gtk.gdk.INTERP_NEAREST
+    return gtk.gdk.INTERP_TILES
@@ -0,0 +1,130 @@
+"""pixbufcache.py - Size limited cache for decoded pixbufs."""
+
+import threading
+
+
+class PixbufCache:
+
+    """A cache of pixbufs (or pixbuf animations) that is limited by the
+    total size of their pixel data rather than by the number of entries.
+    When the cache grows beyond its size limit the least recently used
+    pixbufs are evicted.
+
+    The cache may be accessed from several threads at once.
+    """
+
+    def __init__(self, max_size):
+        self._max_size = max_size
+        self._entries = {} # key: [pixbuf, size, time of last use]
+        self._pinned = set() # Keys of pixbufs that are never evicted.
+        self._size = 0
+        self._clock = 0
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """Return the pixbuf stored under <key> and mark it as the most
+        recently used, or return None if there is no such pixbuf.
+        """
+        self._lock.acquire()
+        try:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            self._clock += 1
+            entry[2] = self._clock
+            return entry[0]
+        finally:
+            self._lock.release()
+
+    def put(self, key, pixbuf):
+        """Store <pixbuf> under <key> as the most recently used pixbuf, and
+        evict old pixbufs if the cache has grown too large. The pixbuf
+        just stored is never evicted by this call.
+        """
+        size = get_pixbuf_size(pixbuf)
+        self._lock.acquire()
+        try:
+            self._remove(key)
+            self._clock += 1
+            self._entries[key] = [pixbuf, size, self._clock]
+            self._size += size
+            self._evict(key)
+        finally:
+            self._lock.release()
+
+    def pin(self, keys):
+        """Protect the pixbufs stored under <keys>, and no others, from
+        being evicted, e.g. those of the pages currently displayed. The
+        cache may grow beyond its size limit to hold pinned pixbufs.
+        """
+        self._lock.acquire()
+        try:
+            self._pinned = set(keys)
+        finally:
+            self._lock.release()
+
+    def keep_only(self, keys):
+        """Remove all pixbufs except the ones stored under <keys>."""
+        self._lock.acquire()
+        try:
+            for key in self._entries.keys():
+                if key not in keys:
+                    self._remove(key)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        """Remove all pixbufs from the cache, and unpin all keys."""
+        self._lock.acquire()
+        try:
+            self._entries.clear()
+            self._pinned.clear()
+            self._size = 0
+        finally:
+            self._lock.release()
+
+    def set_max_size(self, max_size):
+        """Set the size limit of the cache to <max_size> bytes, evicting
+        pixbufs if necessary.
+        """
+        self._lock.acquire()
+        try:
+            self._max_size = max_size
+            self._evict()
+        finally:
+            self._lock.release()
+
+    def __contains__(self, key):
+        return key in self._entries
+
+    def _remove(self, key):
+        """Remove the pixbuf stored under <key>, if any. The lock must be
+        held by the caller.
+        """
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= entry[1]
+
+    def _evict(self, keep=None):
+        """Remove least recently used pixbufs, except the one stored under
+        <keep> and pinned ones, until the cache is within its size limit.
+        The lock must be held by the caller.
+        """
+        while self._size > self._max_size and len(self._entries) > 1:
+            oldest = None
+            for key, entry in self._entries.iteritems():
+                if (key != keep and key not in self._pinned and
+                  (oldest is None or entry[2] < self._entries[oldest][2])):
+                    oldest = key
+            if oldest is None:
+                break
+            self._remove(oldest)
+
+
+def get_pixbuf_size(pixbuf):
+    """Return the approximate size in bytes of the pixel data of <pixbuf>.
+    For animations, the size of the static image is used.
+    """
+    if hasattr(pixbuf, 'get_static_image'):
+        pixbuf = pixbuf.get_static_image()
+    return pixbuf.get_rowstride() * pixbuf.get_height()
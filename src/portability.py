@@ -45,3 +45,18 @@ def get_data_directory():
         base_path = os.getenv('XDG_DATA_HOME',
             os.path.join(get_home_directory(), '.local/share'))
         return os.path.join(base_path, 'comix')
+
+
+def get_number_of_cpus():
+    """Return the number of CPUs available on the system, or 1 if that can
+    not be determined.
+    """
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        pass
+    try:
+        return max(1, int(os.sysconf('SC_NPROCESSORS_ONLN')))
+    except (AttributeError, ValueError, OSError):
+        return 1
@@ -8,6 +8,7 @@ import pango
 
 import constants
 import labels
+import portability
 
 ZOOM_MODE_BEST = 0
 ZOOM_MODE_WIDTH = 1
@@ -24,6 +25,10 @@ prefs = {
     'bg colour': (5000, 5000, 5000),
     'checkered bg for transparent images': True,
     'cache': True,
+    'cache size': 256,
+    'number of pages to cache ahead': 3,
+    'read zip pages into memory': True,
+    'number of extraction threads': min(4, portability.get_number_of_cpus()),
     'stretch': False,
     'default double page': False,
     'default fullscreen': False,
@@ -247,6 +252,40 @@ class _PreferencesDialog(gtk.Dialog):
         cache_button.set_tooltip_text(
             _('Cache the images that are next to the currently viewed image in order to speed up browsing. Since the speed improvements are quite big, it is recommended that you have this preference set, unless you are running short on free RAM.'))
         page.add_row(cache_button)
+        label = gtk.Label('%s:' % _('Cache size (MiB)'))
+        adjustment = gtk.Adjustment(prefs['cache size'], 16, 4096, 16, 64)
+        cache_size_spinner = gtk.SpinButton(adjustment)
+        cache_size_spinner.connect('value_changed', self._spinner_cb,
+            'cache size')
+        cache_size_spinner.set_tooltip_text(
+            _('The maximum amount of memory used for decoded images. When the cache is full, the images that were least recently viewed are removed from it.'))
+        page.add_row(label, cache_size_spinner)
+        label = gtk.Label('%s:' % _('Pages to cache ahead'))
+        adjustment = gtk.Adjustment(prefs['number of pages to cache ahead'],
+            1, 20, 1, 5)
+        ahead_spinner = gtk.SpinButton(adjustment)
+        ahead_spinner.connect('value_changed', self._spinner_cb,
+            'number of pages to cache ahead')
+        ahead_spinner.set_tooltip_text(
+            _('Decode this many pages ahead of the current page, in the direction you are reading, in the background.'))
+        page.add_row(label, ahead_spinner)
+        memory_button = gtk.CheckButton(
+            _('Read pages from ZIP archives directly into memory.'))
+        memory_button.set_active(prefs['read zip pages into memory'])
+        memory_button.connect('toggled', self._check_button_cb,
+            'read zip pages into memory')
+        memory_button.set_tooltip_text(
+            _('Decode the pages of ZIP archives (.cbz) straight from the archive instead of first extracting them to a temporary directory. This saves disk I/O, but is only applied to archives opened after the preference is changed.'))
+        page.add_row(memory_button)
+        label = gtk.Label('%s:' % _('Number of extraction threads'))
+        adjustment = gtk.Adjustment(prefs['number of extraction threads'],
+            1, 16, 1, 2)
+        threads_spinner = gtk.SpinButton(adjustment)
+        threads_spinner.connect('value_changed', self._spinner_cb,
+            'number of extraction threads')
+        threads_spinner.set_tooltip_text(
+            _('Extract this many files at the same time from ZIP and tar archives. Higher values make use of more processor cores.'))
+        page.add_row(label, threads_spinner)
         notebook.append_page(page, gtk.Label(_('Behaviour')))
 
         # ----------------------------------------------------------------
@@ -355,6 +394,13 @@ class _PreferencesDialog(gtk.Dialog):
         elif preference == 'slideshow delay':
             prefs[preference] = int(value * 1000)
             self._window.slideshow.update_delay()
+        elif preference == 'number of extraction threads':
+            prefs[preference] = int(value)
+        elif preference == 'cache size':
+            prefs[preference] = int(value)
+            self._window.file_handler.update_cache_size()
+        elif preference == 'number of pages to cache ahead':
+            prefs[preference] = int(value)
         elif preference == 'thumbnail size':
             prefs[preference] = int(value)
             self._window.thumbnailsidebar.resize()
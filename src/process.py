@@ -1,7 +1,14 @@
 """process.py - Process spawning module."""
 
 import gc
+import os
 import subprocess
+try: # The multiprocessing module is new in Python 2.6.
+    import multiprocessing
+except ImportError:
+    multiprocessing = None
+
+import portability
 
 
 class Process:
@@ -15,11 +22,14 @@ class Process:
     # TODO: I can no longer reproduce the issue. Check if this version of
     # process.py still solves it.
 
-    def __init__(self, args):
+    def __init__(self, args, merge_stderr=True):
         """Setup a Process where <args> is a sequence of arguments that defines
-        the process, e.g. ['ls', '-a'].
+        the process, e.g. ['ls', '-a']. If <merge_stderr> is False the
+        process' stderr is discarded instead of being mixed into its stdout,
+        which is needed when the output is binary data.
         """
         self._args = args
+        self._merge_stderr = merge_stderr
         self._proc = None
     
     def _exec(self):
@@ -27,7 +37,16 @@ class Process:
         (NOTE: separate function to make python2.4 exception syntax happy)
         """
         try:
-            self._proc = subprocess.Popen(self._args, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            if self._merge_stderr:
+                self._proc = subprocess.Popen(self._args,
+                    stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+            else:
+                devnull = open(os.devnull, 'wb')
+                try:
+                    self._proc = subprocess.Popen(self._args,
+                        stdout=subprocess.PIPE, stderr=devnull)
+                finally:
+                    devnull.close()
             return self._proc.stdout
         except Exception:
             return None
@@ -47,3 +66,70 @@ class Process:
         if self._proc is None:
             raise Exception('Process not spawned.')
         return self._proc.wait()
+
+
+def map_unordered(function, items, workers=None):
+    """Call <function> with each of <items> in a pool of <workers>
+    processes, by default one per CPU. Return a _MapResults iterator that
+    yields the return values as soon as they are ready, so not
+    necessarily in the order of <items>. Its close() method abandons the
+    remaining work, and may be called from another thread than the one
+    iterating.
+
+    <function> must be defined at module level, and the items and return
+    values must be picklable. The calls are made one at a time in the
+    iterating thread if there is only one worker or if the
+    multiprocessing module is missing.
+    """
+    if workers is None:
+        workers = portability.get_number_of_cpus()
+    return _MapResults(function, items, workers)
+
+
+class _MapResults:
+
+    """The iterator returned by map_unordered()."""
+
+    def __init__(self, function, items, workers):
+        self._function = function
+        self._items = iter(items)
+        self._pool = None
+        self._closed = False
+        if multiprocessing is not None and workers > 1 and len(items) > 1:
+            self._pool = multiprocessing.Pool(min(workers, len(items)))
+            self._results = self._pool.imap_unordered(function, items)
+            self._pool.close()
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        if self._pool is None:
+            if self._closed:
+                raise StopIteration
+            return self._function(self._items.next())
+        # Wait in short steps, since a terminated pool never delivers the
+        # results that are left.
+        while not self._closed:
+            try:
+                return self._results.next(0.1)
+            except multiprocessing.TimeoutError:
+                pass
+            except StopIteration:
+                self._pool.join()
+                self._closed = True
+                raise
+        raise StopIteration
+
+    def close(self):
+        """Abandon the work that is left, terminating the worker
+        processes.
+        """
+        if self._closed:
+            return
+        self._closed = True
+        if self._pool is not None:
+            self._pool.terminate()
+
+    def __del__(self):
+        self.close()
@@ -0,0 +1,112 @@
+"""profiler.py - Optional timing of the stages of drawing a page.
+
+Profiling is disabled by default. When enabled (see comix.py), the time
+spent in each stage of every page draw (waiting on extraction, decoding,
+scaling etc.) is recorded, and a rolling summary with the median and the
+95th percentile per stage is kept. The timings can also be written to a
+log file.
+"""
+
+import time
+
+# The number of draws that the rolling summary is computed over.
+_HISTORY_LENGTH = 100
+
+# Stages in the order they happen when a page is drawn.
+STAGES = ('wait', 'decode', 'scale', 'enhance', 'smart bg', 'histogram',
+    'cacheing', 'thumbnails', 'total')
+
+_enabled = False
+_log = None
+_frame = None
+_history = []
+
+
+def enable(log_path=None):
+    """Enable profiling. If <log_path> is given, the timings of every draw
+    are appended to the file at that path.
+    """
+    global _enabled, _log
+    _enabled = True
+    if log_path is not None:
+        try:
+            _log = open(log_path, 'a')
+        except IOError:
+            print '! Could not open profiling log %s' % log_path
+
+
+def clock():
+    """Return a start time to be passed to add() later, or None if no
+    draw is being profiled at the moment.
+    """
+    if _frame is None:
+        return None
+    return time.time()
+
+
+def add(stage, start):
+    """Add the time passed since <start>, as returned by clock(), to
+    <stage> of the draw being profiled.
+    """
+    if start is None or _frame is None:
+        return
+    _frame[stage] = _frame.get(stage, 0.0) + time.time() - start
+
+
+def begin_frame():
+    """Start profiling a new draw."""
+    global _frame
+    if _enabled:
+        _frame = {'total': time.time()}
+
+
+def end_frame(page=None):
+    """Finish profiling the current draw of <page>. Return a short summary
+    string suitable for the statusbar, or None if profiling is disabled.
+    """
+    global _frame
+    if _frame is None:
+        return None
+    _frame['total'] = time.time() - _frame['total']
+    _history.append(_frame)
+    del _history[:-_HISTORY_LENGTH]
+    if _log is not None:
+        _log.write('page %s\t%s\n' % (page, '\t'.join(['%s=%.1f' %
+            (stage, _frame[stage] * 1000) for stage in STAGES
+            if stage in _frame])))
+        _log.flush()
+    _frame = None
+    return ', '.join(['%s %.0f/%.0f' % (stage, p50, p95)
+        for stage, p50, p95 in get_summary()
+        if p95 >= 1.0 or stage == 'total']) + ' ms'
+
+
+def get_summary():
+    """Return a list of tuples (stage, median, 95th percentile), with the
+    times in milliseconds, over the latest draws.
+    """
+    summary = []
+    for stage in STAGES:
+        times = [frame.get(stage, 0.0) * 1000 for frame in _history]
+        if not times:
+            continue
+        times.sort()
+        summary.append((stage, _percentile(times, 0.5),
+            _percentile(times, 0.95)))
+    return summary
+
+
+def finish():
+    """Write the rolling summary to the log file, if any, and close it."""
+    global _log
+    if _log is None:
+        return
+    _log.write('summary over %d draws (p50/p95 ms)\t%s\n' % (len(_history),
+        '\t'.join(['%s=%.1f/%.1f' % values for values in get_summary()])))
+    _log.close()
+    _log = None
+
+
+def _percentile(sorted_values, fraction):
+    """Return the value at <fraction> in the list <sorted_values>."""
+    return sorted_values[int(round((len(sorted_values) - 1) * fraction))]
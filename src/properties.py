@@ -142,7 +142,7 @@ class _PropertiesDialog(gtk.Dialog):
         # ----------------------------------------------------------------
         # Image tab
         # ----------------------------------------------------------------
-        path = window.file_handler.get_path_to_page()
+        path = window.file_handler.get_extracted_path_to_page()
         page = _Page()
         thumb = window.file_handler.get_thumbnail(width=200, height=128)
         page.set_thumbnail(thumb)
@@ -0,0 +1,263 @@
+"""rarreader.py - Read the member index of RAR archives.
+
+The headers of RAR (both 1.5-4.x and 5.0) archives are parsed directly so
+that the names, offsets and sizes of the members are known without spawning
+any external process. Members that are stored (uncompressed), unencrypted
+and not part of a solid stream can then be read straight from the archive
+file by seeking. All other members still have to be decompressed by the
+"unrar" program.
+"""
+
+import struct
+
+_RAR4_MARKER = 'Rar!\x1a\x07\x00'
+_RAR5_MARKER = 'Rar!\x1a\x07\x01\x00'
+
+
+class RarMember:
+
+    """Information about a single member of a RAR archive, as read from
+    its file header.
+    """
+
+    def __init__(self, name, offset, packed_size, unpacked_size, stored,
+      solid, encrypted, is_dir):
+        self.name = name
+        self.offset = offset
+        self.packed_size = packed_size
+        self.unpacked_size = unpacked_size
+        self.stored = stored
+        self.solid = solid
+        self.encrypted = encrypted
+        self.is_dir = is_dir
+
+    def is_seekable(self):
+        """Return True if the data of the member can be read verbatim from
+        the archive file at its offset.
+        """
+        return self.stored and not self.solid and not self.encrypted
+
+
+def read_index(path):
+    """Return a list of RarMember objects, in archive order, for the files
+    (but not directories) in the RAR archive at <path>. Return None if the
+    index can not be read, e.g. for multi-volume archives, archives with
+    encrypted headers or corrupt archives. The caller should then fall back
+    to listing the archive with the "unrar" program.
+    """
+    try:
+        fd = open(path, 'rb')
+    except IOError:
+        return None
+    try:
+        try:
+            marker = fd.read(8)
+            if marker.startswith(_RAR4_MARKER):
+                members = _read_rar4_index(fd)
+            elif marker == _RAR5_MARKER:
+                members = _read_rar5_index(fd)
+            else:
+                return None
+        except (IndexError, ValueError, struct.error, IOError):
+            return None
+    finally:
+        fd.close()
+    if members is None:
+        return None
+    return [member for member in members if not member.is_dir]
+
+
+def _read_rar4_index(fd):
+    """Return a list of RarMembers from the RAR 1.5-4.x archive <fd>, or
+    None if the archive is not supported.
+    """
+    members = []
+    solid = False
+    pos = len(_RAR4_MARKER)
+    while True:
+        fd.seek(pos)
+        head = fd.read(7)
+        if len(head) < 7:
+            break
+        crc, head_type, flags, head_size = struct.unpack('<HBHH', head)
+        if head_size < 7:
+            return None
+        body = fd.read(head_size - 7)
+        if len(body) < head_size - 7:
+            return None
+        add_size = 0
+        if head_type == 0x73: # Main archive header.
+            if flags & 0x0081: # Multi-volume or encrypted headers.
+                return None
+            solid = bool(flags & 0x0008)
+        elif head_type == 0x74: # File header.
+            if flags & 0x0003: # Continued from/in another volume.
+                return None
+            (packed_size, unpacked_size, host_os, file_crc, ftime,
+             unpack_version, method, name_size, attr) = struct.unpack(
+                '<IIBIIBBHI', body[:25])
+            name_pos = 25
+            if flags & 0x0100: # 64 bit sizes.
+                high_packed, high_unpacked = struct.unpack('<II',
+                    body[25:33])
+                packed_size += high_packed << 32
+                unpacked_size += high_unpacked << 32
+                name_pos = 33
+            name = body[name_pos:name_pos + name_size]
+            if flags & 0x0200:
+                name = _decode_rar4_name(name)
+            name = name.replace('\\', '/')
+            add_size = packed_size
+            members.append(RarMember(name, pos + head_size, packed_size,
+                unpacked_size, method == 0x30, solid or bool(flags & 0x0010),
+                bool(flags & 0x0004), flags & 0x00e0 == 0x00e0))
+        elif flags & 0x8000: # Header followed by data of ADD_SIZE bytes.
+            add_size = struct.unpack('<I', body[:4])[0]
+        if head_type == 0x7b: # End of archive.
+            break
+        pos += head_size + add_size
+    return members
+
+
+def _decode_rar4_name(name):
+    """Return the UTF-8 encoded form of the Unicode filename <name> found
+    in a RAR 1.5-4.x file header. Such names are either plain UTF-8, or an
+    ASCII name followed by a null byte and a compressed Unicode form.
+    """
+    if '\x00' not in name:
+        return name
+    std_name, enc_name = name.split('\x00', 1)
+    if not enc_name:
+        return std_name
+    chars = []
+    pos = 0
+    enc_pos = 1
+    high_byte = ord(enc_name[0])
+    flags = 0
+    flag_bits = 0
+    try:
+        while enc_pos < len(enc_name):
+            if flag_bits == 0:
+                flags = ord(enc_name[enc_pos])
+                enc_pos += 1
+                flag_bits = 8
+            flag_bits -= 2
+            mode = (flags >> flag_bits) & 3
+            if mode == 0:
+                chars.append(unichr(ord(enc_name[enc_pos])))
+                enc_pos += 1
+            elif mode == 1:
+                chars.append(unichr(ord(enc_name[enc_pos]) +
+                    (high_byte << 8)))
+                enc_pos += 1
+            elif mode == 2:
+                chars.append(unichr(ord(enc_name[enc_pos]) +
+                    (ord(enc_name[enc_pos + 1]) << 8)))
+                enc_pos += 2
+            else:
+                length = ord(enc_name[enc_pos])
+                enc_pos += 1
+                if length & 0x80:
+                    correction = ord(enc_name[enc_pos])
+                    enc_pos += 1
+                    for i in xrange((length & 0x7f) + 2):
+                        low_byte = (ord(std_name[pos + i]) + correction) & 0xff
+                        chars.append(unichr((high_byte << 8) + low_byte))
+                else:
+                    for i in xrange(length + 2):
+                        chars.append(unichr(ord(std_name[pos + i])))
+            pos = len(chars)
+    except IndexError:
+        return std_name
+    return u''.join(chars).encode('utf-8')
+
+
+def _read_rar5_index(fd):
+    """Return a list of RarMembers from the RAR 5.0 archive <fd>, or None
+    if the archive is not supported.
+    """
+    members = []
+    solid = False
+    pos = len(_RAR5_MARKER)
+    while True:
+        fd.seek(pos)
+        head = fd.read(7) # CRC32 and a header size vint of at most 3 bytes.
+        if len(head) < 5:
+            break
+        head_size, size_end = _read_vint(head, 4)
+        fd.seek(pos + size_end)
+        header = fd.read(head_size)
+        if len(header) < head_size:
+            return None
+        head_type, i = _read_vint(header, 0)
+        head_flags, i = _read_vint(header, i)
+        extra_size = data_size = 0
+        if head_flags & 0x0001:
+            extra_size, i = _read_vint(header, i)
+        if head_flags & 0x0002:
+            data_size, i = _read_vint(header, i)
+        data_offset = pos + size_end + head_size
+        if head_type == 1: # Main archive header.
+            archive_flags, i = _read_vint(header, i)
+            if archive_flags & 0x0001: # Multi-volume.
+                return None
+            solid = bool(archive_flags & 0x0004)
+        elif head_type == 4: # Archive encryption header.
+            return None
+        elif head_type == 2: # File header.
+            if head_flags & 0x0018: # Continued from/in another volume.
+                return None
+            file_flags, i = _read_vint(header, i)
+            unpacked_size, i = _read_vint(header, i)
+            attr, i = _read_vint(header, i)
+            if file_flags & 0x0002: # Modification time.
+                i += 4
+            if file_flags & 0x0004: # Data CRC32.
+                i += 4
+            if file_flags & 0x0008: # Unknown unpacked size.
+                return None
+            compression, i = _read_vint(header, i)
+            host_os, i = _read_vint(header, i)
+            name_size, i = _read_vint(header, i)
+            name = header[i:i + name_size]
+            encrypted = False
+            if extra_size:
+                encrypted = _has_rar5_encryption_record(
+                    header[head_size - extra_size:])
+            members.append(RarMember(name, data_offset, data_size,
+                unpacked_size, (compression >> 7) & 7 == 0,
+                solid or bool(compression & 0x0040), encrypted,
+                bool(file_flags & 0x0001)))
+        elif head_type == 5: # End of archive.
+            break
+        pos = data_offset + data_size
+    return members
+
+
+def _has_rar5_encryption_record(extra):
+    """Return True if the RAR 5.0 extra area <extra> holds a file
+    encryption record.
+    """
+    i = 0
+    while i < len(extra):
+        size, data_start = _read_vint(extra, i)
+        record_type = _read_vint(extra, data_start)[0]
+        if record_type == 0x01:
+            return True
+        i = data_start + size
+    return False
+
+
+def _read_vint(data, pos):
+    """Read a RAR 5.0 variable length integer from <data> at <pos>. Return
+    a tuple (value, position of the first byte after the integer).
+    """
+    value = 0
+    shift = 0
+    while True:
+        byte = ord(data[pos])
+        pos += 1
+        value |= (byte & 0x7f) << shift
+        if not byte & 0x80:
+            return value, pos
+        shift += 7
@@ -13,6 +13,7 @@ class Statusbar(gtk.Statusbar):
         self._page_info = ''
         self._resolution = ''
         self._filename = ''
+        self._profile = ''
 
     def set_message(self, message):
         """Set a specific message (such as an error message) on the statusbar,
@@ -43,8 +44,16 @@ class Statusbar(gtk.Statusbar):
         """Update the filename."""
         self._filename = encoding.to_unicode(filename)
 
+    def set_profile(self, profile):
+        """Update the profiling summary. It is only displayed if non-empty.
+        """
+        self._profile = profile
+
     def update(self):
         """Set the statusbar to display the current state."""
+        text = ' %s      |      %s      |      %s' % (self._page_info,
+            self._resolution, self._filename)
+        if self._profile:
+            text += '      |      %s' % self._profile
         self.pop(0)
-        self.push(0, ' %s      |      %s      |      %s' %
-            (self._page_info, self._resolution, self._filename))
+        self.push(0, text)
@@ -1,5 +1,6 @@
 """thumbbar.py - Thumbnail sidebar for main window."""
 
+import threading
 import urllib
 
 import gtk
@@ -11,10 +12,19 @@ import image
 from preferences import prefs
 import thumbnail
 
+# The number of threads that load thumbnails.
+_LOADER_THREADS = 2
+
 
 class ThumbnailSidebar(gtk.HBox):
 
-    """A thumbnail sidebar including scrollbar for the main window."""
+    """A thumbnail sidebar including scrollbar for the main window.
+
+    When a file is loaded the sidebar is first filled with placeholders,
+    which are then replaced by the real thumbnails as they are loaded by
+    a few threads. The thumbnails currently in view are loaded first, then
+    the ones closest to the current page.
+    """
 
     def __init__(self, window):
         gtk.HBox.__init__(self, False, 0)
@@ -22,6 +32,10 @@ class ThumbnailSidebar(gtk.HBox):
         self._loaded = False
         self._load_task = None
         self._height = 0
+        self._placeholder = None
+        self._queue = [] # Page numbers of the thumbnails left to load.
+        self._queue_condition = threading.Condition()
+        self._generation = 0
 
         self._liststore = gtk.ListStore(gtk.gdk.Pixbuf)
         self._treeview = gtk.TreeView(self._liststore)
@@ -54,6 +68,7 @@ class ThumbnailSidebar(gtk.HBox):
         self._treeview.connect('drag_data_get', self._drag_data_get)
         self._selection.connect('changed', self._selection_event)
         self._layout.connect('scroll_event', self._scroll_event)
+        self._vadjust.connect('value-changed', self._update_queue)
 
     def get_width(self):
         """Return the width in pixels of the ThumbnailSidebar."""
@@ -69,11 +84,17 @@ class ThumbnailSidebar(gtk.HBox):
 
     def clear(self):
         """Clear the ThumbnailSidebar of any loaded thumbnails."""
+        self._queue_condition.acquire()
+        self._generation += 1
+        del self._queue[:]
+        self._queue_condition.release()
+        if self._load_task is not None:
+            gobject.source_remove(self._load_task)
+            self._load_task = None
         self._liststore.clear()
         self._layout.set_size(0, 0)
         self._height = 0
         self._loaded = False
-        self._stop_update = True
 
     def resize(self):
         """Reload the thumbnails with the size specified by in the
@@ -113,31 +134,120 @@ class ThumbnailSidebar(gtk.HBox):
             value = max(0, value)
             value = min(self._vadjust.upper - self._vadjust.page_size, value)
             self._vadjust.set_value(value)
+        self._update_queue()
 
     def _load(self):
+        """Fill the sidebar with placeholders and start the threads that
+        load the real thumbnails.
+        """
         self._load_task = None
-        if self._window.file_handler.archive_type is not None:
+        generation = self._generation
+        pages = self._window.file_handler.get_number_of_pages()
+        if pages == 0:
+            return False
+        self._placeholder = _get_placeholder(prefs['thumbnail size'])
+        for i in xrange(pages):
+            self._liststore.append([self._placeholder])
+        while gtk.events_pending():
+            gtk.main_iteration(False)
+        if generation != self._generation:
+            return False
+        self._height = self._treeview.get_background_area(0,
+            self._column).height * pages
+        self._layout.set_size(0, self._height)
+        self._queue_condition.acquire()
+        self._queue[:] = range(1, pages + 1)
+        self._queue_condition.release()
+        self.update_select()
+        for i in xrange(_LOADER_THREADS):
+            thread = threading.Thread(target=self._thread_load,
+                args=(generation,))
+            thread.setDaemon(False)
+            thread.start()
+        return False
+
+    def _update_queue(self, *args):
+        """Reorder the queue of thumbnails left to load so that the ones in
+        view come first, followed by the ones closest to the current page.
+        """
+        if not self._loaded or not self._window.file_handler.file_loaded:
+            return
+        visible = self._get_visible_pages()
+        current = self._window.file_handler.get_current_page()
+        self._queue_condition.acquire()
+        if self._queue:
+            visible_set = set(visible)
+            queued = set(self._queue)
+            rest = [page for page in self._queue if page not in visible_set]
+            rest.sort(key=lambda page: abs(page - current))
+            self._queue[:] = [page for page in visible
+                if page in queued] + rest
+        self._queue_condition.release()
+
+    def _get_visible_pages(self):
+        """Return a list of the page numbers of the thumbnails that are
+        (at least partly) in view.
+        """
+        top = self._treeview.get_path_at_pos(1,
+            int(self._vadjust.get_value()))
+        if top is None:
+            return []
+        bottom = self._treeview.get_path_at_pos(1,
+            int(self._vadjust.get_value() + self._vadjust.page_size))
+        if bottom is None:
+            last = len(self._liststore)
+        else:
+            last = bottom[0][0] + 1
+        return range(top[0][0] + 1, last + 1)
+
+    def _thread_load(self, generation):
+        """Load the thumbnails in the queue until it is empty, or until
+        the sidebar is cleared (and <generation> is no longer the current
+        one). This is run in separate threads, so the thumbnails are handed
+        over to the main thread through idle callbacks.
+        """
+        file_handler = self._window.file_handler
+        if file_handler.archive_type is not None:
             create = False
         else:
             create = prefs['create thumbnails']
-        self._stop_update = False
-        for i in xrange(1, self._window.file_handler.get_number_of_pages() + 1):
-            pixbuf = self._window.file_handler.get_thumbnail(i,
-                prefs['thumbnail size'], prefs['thumbnail size'], create)
-            if prefs['show page numbers on thumbnails']:
-                _add_page_number(pixbuf, i)
-            pixbuf = image.add_border(pixbuf, 1)
-            self._liststore.append([pixbuf])
-            while gtk.events_pending():
-                gtk.main_iteration(False)
-            if self._stop_update:
+        size = prefs['thumbnail size']
+        while True:
+            self._queue_condition.acquire()
+            if generation != self._generation or not self._queue:
+                self._queue_condition.release()
                 return
-            self._height += self._treeview.get_background_area(i - 1,
-                self._column).height
-            self._layout.set_size(0, self._height)
-        self._stop_update = True
-        self.update_select()
-    
+            # Prefer thumbnails that can be loaded without waiting for
+            # their pages to be extracted.
+            for page in self._queue:
+                if file_handler.is_thumbnail_ready(page):
+                    break
+            else:
+                page = self._queue[0]
+            self._queue.remove(page)
+            self._queue_condition.release()
+
+            pixbuf = file_handler.load_thumbnail(page, size, size, create)
+            if pixbuf is not None:
+                pixbuf = _finish_thumbnail(pixbuf, page)
+            gobject.idle_add(self._set_thumbnail, generation, page, pixbuf)
+
+    def _set_thumbnail(self, generation, page, pixbuf):
+        """Replace the placeholder for <page> with <pixbuf>, or with a
+        missing image icon if <pixbuf> is None.
+        """
+        if generation != self._generation:
+            return False
+        if pixbuf is None:
+            size = prefs['thumbnail size']
+            pixbuf = image.fit_in_rectangle(self._window.render_icon(
+                gtk.STOCK_MISSING_IMAGE, gtk.ICON_SIZE_DIALOG), size, size)
+            pixbuf = _finish_thumbnail(pixbuf, page)
+        self._liststore.set(self._liststore.get_iter(page - 1), 0, pixbuf)
+        self._height += pixbuf.get_height() - self._placeholder.get_height()
+        self._layout.set_size(0, self._height)
+        return False
+
     def _get_selected_row(self):
         """Return the index of the currently selected row."""
         try:
@@ -166,7 +276,8 @@ class ThumbnailSidebar(gtk.HBox):
         """
         try:
             selected = self._get_selected_row()
-            path = self._window.file_handler.get_path_to_page(selected + 1)
+            path = self._window.file_handler.get_extracted_path_to_page(
+                selected + 1)
             uri = 'file://localhost' + urllib.pathname2url(path)
             selection.set_uris([uri])
         except Exception:
@@ -188,6 +299,25 @@ class ThumbnailSidebar(gtk.HBox):
         context.set_icon_pixbuf(pointer, -5, -5)
 
 
+def _get_placeholder(size):
+    """Return a pixbuf to show in place of a thumbnail of <size> that has
+    not been loaded yet.
+    """
+    pixbuf = gtk.gdk.Pixbuf(gtk.gdk.COLORSPACE_RGB, False, 8,
+        max(1, size * 2 // 3), size)
+    pixbuf.fill(0xddddddff)
+    return image.add_border(pixbuf, 1)
+
+
+def _finish_thumbnail(pixbuf, page):
+    """Return <pixbuf> as it should be displayed in the sidebar for
+    <page>, with a border and optionally the page number added.
+    """
+    if prefs['show page numbers on thumbnails']:
+        _add_page_number(pixbuf, page)
+    return image.add_border(pixbuf, 1)
+
+
 def _add_page_number(pixbuf, page):
     """Add page number <page> in a black rectangle in the top left corner of
     <pixbuf>. This is highly dependent on the dimensions of the built-in
@@ -11,8 +11,6 @@ try: # The md5 module is deprecated as of Python 2.5, replaced by hashlib.
 except ImportError:
     from md5 import new as md5
 import re
-import shutil
-import tempfile
 
 import gtk
 from PIL import Image
@@ -20,10 +18,11 @@ from PIL import Image
 import archive
 import constants
 import filehandler
+import image
+import process
 
 _thumbdir = os.path.join(constants.HOME_DIR, '.thumbnails/normal')
 
-from archive import hfs_hack
 
 def get_thumbnail(path, create=True, dst_dir=_thumbdir):
     """Return a thumbnail pixbuf for the file at <path> by looking in the
@@ -57,6 +56,47 @@ def get_thumbnail(path, create=True, dst_dir=_thumbdir):
         return None
 
 
+def generate_many(paths, dst_dir=_thumbdir, workers=None):
+    """Create and store thumbnails for all the files at <paths>, with
+    <dst_dir> as the base thumbnail directory. The work is spread over a
+    pool of <workers> processes, by default one per CPU.
+
+    Return an iterator that yields a tuple (path, success) for each path
+    as soon as its thumbnail is done, so not necessarily in the order of
+    <paths>. <success> is True if a thumbnail for the file exists now.
+    The remaining work is abandoned when the close() method of the
+    iterator is called (see process.map_unordered()).
+
+    The thumbnails are created one at a time in the calling process if
+    there is only one worker or if the multiprocessing module is missing.
+    Callers in the GUI process that want only a few thumbnails should ask
+    for that, rather than forking a pool from a process with many threads.
+    """
+    return process.map_unordered(_generate,
+        [(path, dst_dir) for path in paths], workers)
+
+
+def _generate(args):
+    """Create and store a thumbnail for the file at <path>, where <args>
+    is a tuple (path, dst_dir), unless one exists already. Return a tuple
+    (path, success). This is run in the worker processes of
+    generate_many().
+    """
+    path, dst_dir = args
+    try:
+        return path, get_thumbnail(path, True, dst_dir) is not None
+    except Exception:
+        return path, False
+
+
+def get_thumbnail_path(path, dst_dir=_thumbdir):
+    """Return the path where the thumbnail for the file at <path> is
+    stored, whether it exists or not, with <dst_dir> as the base thumbnail
+    directory.
+    """
+    return _path_to_thumbpath(path, dst_dir)
+
+
 def delete_thumbnail(path, dst_dir=_thumbdir):
     """Delete the thumbnail (if it exists) for the file at <path>.
     
@@ -87,32 +127,17 @@ def _get_new_thumbnail(path, create, dst_dir):
 
 def _get_new_archive_thumbnail(path, dst_dir):
     """Return a new thumbnail pixbuf for the archive at <path>, and save it
-    to disk; <dst_dir> is the base thumbnail directory.
+    to disk; <dst_dir> is the base thumbnail directory. The cover image is
+    read straight into memory from the archive, and decoded at reduced
+    size.
     """
-    extractor = archive.Extractor()
-    tmpdir = tempfile.mkdtemp(prefix='comix_archive_thumb.')
-    condition = extractor.setup(path, tmpdir)
-    files = extractor.get_files()
-    wanted = _guess_cover(files)
-    if wanted is None:
+    cover = archive.read_chosen_file(path, _guess_cover)
+    if cover is None:
         return None
-    extractor.set_files([wanted])
-    extractor.extract()
-    if extractor._type == archive.ZIP:
-        hack = hfs_hack
-    else:
-        hack = lambda f: f
-    image_path = os.path.join(tmpdir, hack(wanted))
-    condition.acquire()
-    while not extractor.is_ready(wanted):
-        condition.wait()
-    condition.release()
-    pixbuf = _create_thumbnail(path, dst_dir, image_path=image_path)
-    shutil.rmtree(tmpdir)
-    return pixbuf
+    return _create_thumbnail(path, dst_dir, image_data=cover[1])
 
 
-def _create_thumbnail(path, dst_dir, image_path=None):
+def _create_thumbnail(path, dst_dir, image_path=None, image_data=None):
     """Create a thumbnail from the file at <path> and store it if it is
     larger than 128x128 px. A pixbuf for the thumbnail is returned.
 
@@ -120,14 +145,23 @@ def _create_thumbnail(path, dst_dir, image_path=None):
 
     If <image_path> is not None it is used as the path to the image file
     actually used to create the thumbnail image, although the created
-    thumbnail will still be saved as if for <path>.
+    thumbnail will still be saved as if for <path>. Likewise, if
+    <image_data> is not None it is the contents of the image file to use.
     """
-    if image_path is None:
-        image_path = path
-    pixbuf = _get_pixbuf128(image_path)
+    if image_data is not None:
+        try:
+            pixbuf, mime, width, height = \
+                image.load_pixbuf_and_info_at_size(image_data, 128, 128)
+        except Exception:
+            return None
+    else:
+        if image_path is None:
+            image_path = path
+        pixbuf = _get_pixbuf128(image_path)
+        if pixbuf is not None:
+            mime, width, height = gtk.gdk.pixbuf_get_file_info(image_path)
     if pixbuf is None:
         return None
-    mime, width, height = gtk.gdk.pixbuf_get_file_info(image_path)
     if width <= 128 and height <= 128:
         return pixbuf
     mime = mime['mime_types'][0]
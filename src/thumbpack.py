@@ -0,0 +1,364 @@
+"""thumbpack.py - Persistent packs of page thumbnails for archives.
+
+A thumbnail pack is a single file that holds thumbnails of the pages in an
+archive, all fitted to the same size. When the archive is opened again,
+the page thumbnails can be read from the pack instead of being recreated
+from the archive contents. The packs that have not been used for the
+longest time are deleted when the packs grow beyond _MAX_PACKS_SIZE in
+total (see prune_packs()).
+
+The library keeps similar packs of its book covers, one for each cover
+size, keyed by book ID instead of page number.
+
+A pack starts with a header line identifying the archive (by its
+modification time and size), the thumbnail size and the (URL quoted) path
+to the archive. It is followed by
+records, appended as thumbnails are created, each consisting of the page
+number, a stamp and the length of the data as three unsigned big-endian
+32-bit integers, and then the thumbnail as a JPEG or PNG image. The stamp
+identifies the version of the source of the thumbnail, where that can
+change without the pack being invalidated as a whole (see CoverPack).
+A record with no data marks the page as removed.
+
+Only the record headers are read when a pack is opened. Records that have
+been replaced or removed are left in the file until the pack is closed,
+when it is compacted if they make up most of it.
+"""
+
+import os
+import struct
+import threading
+import urllib
+from cStringIO import StringIO
+try: # The md5 module is deprecated as of Python 2.5, replaced by hashlib.
+    from hashlib import md5
+except ImportError:
+    from md5 import new as md5
+
+import constants
+import image
+
+_pack_dir = os.path.join(constants.DATA_DIR, 'thumbnail_packs')
+_cover_pack_dir = os.path.join(constants.DATA_DIR, 'library_cover_packs')
+_MAGIC = 'Comix thumbnail pack 3'
+_RECORD_FORMAT = '>III'
+_RECORD_SIZE = struct.calcsize(_RECORD_FORMAT)
+# A pack is compacted when closed if it has at least this many bytes of
+# replaced or removed records, and they take up more than half of it.
+_COMPACT_MIN_WASTE = 65536
+# The maximum total size in bytes of the page thumbnail packs.
+_MAX_PACKS_SIZE = 64 * 1048576
+
+
+class ThumbnailPack:
+
+    """The thumbnail pack for the archive at <path>, with thumbnails that
+    fit in <size>x<size>. The pack may be used from several threads at
+    once.
+    """
+
+    def __init__(self, path, size, dst_dir=_pack_dir):
+        self._setup(size, dst_dir)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            self._closed = True
+            return
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        path = os.path.normpath(os.path.abspath(path))
+        self._header = '%s %d %d %d %s\n' % (_MAGIC, int(stat.st_mtime),
+            stat.st_size, size, urllib.quote(path))
+        self._pack_path = os.path.join(dst_dir, md5(path).hexdigest() +
+            '.pack')
+
+    def get_size(self):
+        """Return the size of the thumbnails in the pack."""
+        return self._size
+
+    def get(self, page, stamp=0):
+        """Return a pixbuf with the thumbnail of <page>, or None if it is
+        not in the pack or if it was stored with another <stamp>.
+        """
+        self._lock.acquire()
+        try:
+            record = self._get_index().get(page)
+            if record is None or record[0] != stamp or self._closed:
+                return None
+            try:
+                self._file.seek(record[1])
+                data = self._file.read(record[2])
+            except (IOError, OSError):
+                return None
+        finally:
+            self._lock.release()
+        try:
+            return image.load_pixbuf_at_size(data, self._size, self._size)
+        except Exception:
+            return None
+
+    def put(self, page, pixbuf, stamp=0):
+        """Add the thumbnail <pixbuf> of <page> to the pack, with <stamp>,
+        writing it to disk right away.
+        """
+        im = image.pixbuf_to_pil(pixbuf)
+        output = StringIO()
+        if im.mode == 'RGBA':
+            im.save(output, 'PNG')
+        else:
+            im.save(output, 'JPEG', quality=90)
+        self._lock.acquire()
+        try:
+            self._write(page, stamp, output.getvalue())
+        finally:
+            self._lock.release()
+
+    def remove(self, page):
+        """Remove the thumbnail of <page> from the pack, if it is there."""
+        self._lock.acquire()
+        try:
+            if page in self._get_index():
+                self._write(page, 0, '')
+        finally:
+            self._lock.release()
+
+    def close(self):
+        """Close the pack, compacting it first if most of it is taken up
+        by replaced or removed thumbnails. Thumbnails added after this are
+        not stored.
+        """
+        self._lock.acquire()
+        try:
+            if (not self._closed and self._waste >= _COMPACT_MIN_WASTE and
+              self._waste * 2 > self._end):
+                self._compact()
+            self._closed = True
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+        finally:
+            self._lock.release()
+
+    def __contains__(self, page):
+        self._lock.acquire()
+        try:
+            return page in self._get_index()
+        finally:
+            self._lock.release()
+
+    def _setup(self, size, dst_dir):
+        """Initialise the state common to all packs."""
+        self._size = size
+        self._dst_dir = dst_dir
+        self._lock = threading.Lock()
+        # page: (stamp, offset, length) of its thumbnail, read lazily.
+        self._index = None
+        self._end = 0 # Offset of the end of the last intact record.
+        self._waste = 0 # Bytes taken up by replaced or removed records.
+        self._file = None
+        self._writable = False
+        self._closed = False
+
+    def _get_index(self):
+        """Return the dictionary of the stamps and locations of the
+        thumbnails in the pack, reading the record headers of the pack
+        file the first time. A pack for another version of the archive, or
+        another thumbnail size, is treated as empty. The lock must be held
+        by the caller.
+        """
+        if self._index is not None:
+            return self._index
+        self._index = {}
+        if self._closed:
+            return self._index
+        try:
+            self._file = open(self._pack_path, 'rb')
+            if self._file.read(len(self._header)) != self._header:
+                self._file.close()
+                self._file = None
+                return self._index
+            # The modification time tells prune_packs() when the pack was
+            # last used.
+            try:
+                os.utime(self._pack_path, None)
+            except OSError:
+                pass
+            offset = len(self._header)
+            self._file.seek(0, 2)
+            size = self._file.tell()
+            # A truncated record at the end (e.g. after a crash) is
+            # ignored, and overwritten by the next record added.
+            while offset + _RECORD_SIZE <= size:
+                self._file.seek(offset)
+                page, stamp, length = struct.unpack(_RECORD_FORMAT,
+                    self._file.read(_RECORD_SIZE))
+                start = offset + _RECORD_SIZE
+                if start + length > size:
+                    break
+                self._add_to_index(page, stamp, start, length)
+                offset = start + length
+            self._end = offset
+        except (IOError, OSError, struct.error):
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+            self._index = {}
+            self._end = self._waste = 0
+        return self._index
+
+    def _add_to_index(self, page, stamp, start, length):
+        """Record that the thumbnail of <page> with <stamp> is the <length>
+        bytes at <start> in the pack file, or that <page> was removed if
+        <length> is 0. The lock must be held by the caller.
+        """
+        if page in self._index:
+            self._waste += _RECORD_SIZE + self._index[page][2]
+        if length:
+            self._index[page] = (stamp, start, length)
+        else:
+            self._waste += _RECORD_SIZE
+            self._index.pop(page, None)
+
+    def _write(self, page, stamp, data):
+        """Append a record for <page> with <stamp> and <data> to the pack
+        file. The lock must be held by the caller.
+        """
+        if self._closed:
+            return
+        self._get_index()
+        try:
+            if not self._writable:
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                if not os.path.isdir(self._dst_dir):
+                    os.makedirs(self._dst_dir, 0700)
+                if self._end:
+                    self._file = open(self._pack_path, 'r+b')
+                    self._file.seek(self._end)
+                    self._file.truncate()
+                else:
+                    self._file = open(self._pack_path, 'w+b')
+                    self._file.write(self._header)
+                    self._end = len(self._header)
+                self._writable = True
+            self._file.seek(self._end)
+            self._file.write(struct.pack(_RECORD_FORMAT, page, stamp,
+                len(data)) + data)
+            self._file.flush()
+            self._add_to_index(page, stamp, self._end + _RECORD_SIZE,
+                len(data))
+            self._end = self._file.tell()
+        except (IOError, OSError):
+            print '! thumbpack.py: Could not write', self._pack_path
+            self._closed = True
+
+    def _compact(self):
+        """Rewrite the pack file with only the current thumbnails in it.
+        The lock must be held by the caller.
+        """
+        tmp_path = self._pack_path + '.tmp'
+        try:
+            output = open(tmp_path, 'wb')
+            try:
+                output.write(self._header)
+                for page, (stamp, start, length) in self._index.items():
+                    self._file.seek(start)
+                    output.write(struct.pack(_RECORD_FORMAT, page, stamp,
+                        length) + self._file.read(length))
+            finally:
+                output.close()
+            self._file.close()
+            self._file = None
+            os.rename(tmp_path, self._pack_path)
+        except (IOError, OSError):
+            print '! thumbpack.py: Could not compact', self._pack_path
+            try:
+                os.remove(tmp_path)
+            except OSError:
+                pass
+
+
+class CoverPack(ThumbnailPack):
+
+    """The pack of library covers of <size>, keyed by book ID. The covers
+    do not come from a single archive, so the pack as a whole is never
+    invalidated. Instead the stamp of each cover should identify the
+    version of its source, and covers of books that are removed should
+    be removed from the pack too.
+    """
+
+    def __init__(self, size, dst_dir=_cover_pack_dir):
+        self._setup(size, dst_dir)
+        self._header = '%s %d\n' % (_MAGIC, size)
+        self._pack_path = os.path.join(dst_dir, '%d.pack' % size)
+
+
+def remove_cover_packs(keep_sizes, dst_dir=_cover_pack_dir):
+    """Delete the packs of library covers in <dst_dir>, except those of
+    the sizes in <keep_sizes>.
+    """
+    try:
+        names = os.listdir(dst_dir)
+    except OSError:
+        return
+    keep = ['%d.pack' % size for size in keep_sizes]
+    for name in names:
+        if name not in keep:
+            try:
+                os.remove(os.path.join(dst_dir, name))
+            except OSError:
+                pass
+
+
+def list_packs(dst_dir=_pack_dir):
+    """Return the paths to the page thumbnail packs in <dst_dir>."""
+    try:
+        names = os.listdir(dst_dir)
+    except OSError:
+        return []
+    return [os.path.join(dst_dir, name) for name in names
+        if name.endswith('.pack')]
+
+
+def read_pack_source(pack_path):
+    """Return a tuple (path, modification time, size) identifying the
+    archive that the page thumbnail pack at <pack_path> was made for.
+    Raise ValueError if the file is not such a pack, or IOError if it can
+    not be read.
+    """
+    fd = open(pack_path, 'rb')
+    try:
+        header = fd.readline().rstrip('\n')
+    finally:
+        fd.close()
+    if not header.startswith(_MAGIC + ' '):
+        raise ValueError('Not a thumbnail pack: %s' % pack_path)
+    fields = header[len(_MAGIC) + 1:].split(' ')
+    if len(fields) != 4:
+        raise ValueError('Not a thumbnail pack: %s' % pack_path)
+    return urllib.unquote(fields[3]), int(fields[0]), int(fields[1])
+
+
+def prune_packs(max_size=_MAX_PACKS_SIZE, dst_dir=_pack_dir):
+    """Delete the page thumbnail packs in <dst_dir> that were used least
+    recently, until they take up no more than <max_size> bytes in total.
+    """
+    packs = []
+    total = 0
+    for pack_path in list_packs(dst_dir):
+        try:
+            stat = os.stat(pack_path)
+        except OSError:
+            continue
+        packs.append((stat.st_mtime, stat.st_size, pack_path))
+        total += stat.st_size
+    packs.sort()
+    for mtime, size, pack_path in packs:
+        if total <= max_size:
+            break
+        try:
+            os.remove(pack_path)
+            total -= size
+        except OSError:
+            pass
@@ -12,6 +12,7 @@ from PIL import Image
 import encoding
 import labels
 import constants
+import thumbpack
 
 _dialog = None
 _thumb_base = os.path.join(constants.HOME_DIR, '.thumbnails')
@@ -91,14 +92,10 @@ class _ThumbnailMaintenanceDialog(gtk.Dialog):
     def _update_num_and_size(self):
         self._num_thumbs = 0
         size_thumbs = 0
-        for subdir in ('normal', 'large'):
-            dir_path = os.path.join(_thumb_base, subdir)
-            if os.path.isdir(dir_path):
-                for entry in os.listdir(dir_path):
-                    entry_path = os.path.join(dir_path, entry)
-                    if os.path.isfile(entry_path):
-                        self._num_thumbs += 1
-                        size_thumbs += os.stat(entry_path).st_size
+        for entry_path, is_pack in _list_thumbnails():
+            if os.path.isfile(entry_path):
+                self._num_thumbs += 1
+                size_thumbs += os.stat(entry_path).st_size
         self._num_thumbs_label.set_text('%d' % self._num_thumbs)
         self._size_thumbs_label.set_text('%.1f MiB' % (size_thumbs / 1048576.0))
 
@@ -161,43 +158,46 @@ class _ThumbnailRemover(gtk.Dialog):
         iteration = 0.0
         removed_thumbs = 0
         size_thumbs = 0
-        for subdir in ('normal', 'large'):
-            dir_path = os.path.join(_thumb_base, subdir)
-            if not os.path.isdir(dir_path):
+        for entry_path, is_pack in _list_thumbnails():
+            if self._destroy:
+                return
+            iteration += 1
+            if not os.path.isfile(entry_path):
                 continue
-            for entry in os.listdir(dir_path):
-                if self._destroy:
-                    return
-                iteration += 1
-                entry_path = os.path.join(dir_path, entry)
-                if not os.path.isfile(entry_path):
-                    continue
-                broken = False
-                try:
-                    stats = os.stat(entry_path)
+            broken = False
+            orig_path = entry_path
+            try:
+                stats = os.stat(entry_path)
+                if is_pack:
+                    orig_path, thumb_mtime, thumb_size = \
+                        thumbpack.read_pack_source(entry_path)
+                    src_stats = os.stat(orig_path)
+                    thumb_mtime = (thumb_mtime, thumb_size)
+                    src_mtime = (int(src_stats.st_mtime), src_stats.st_size)
+                else:
                     info = Image.open(entry_path).info
                     orig_path = _uri_to_path(info['Thumb::URI'])
                     thumb_mtime = int(info['Thumb::MTime'])
                     src_mtime = os.stat(orig_path).st_mtime
+            except Exception:
+                broken = True
+            # Thumb is orphaned or outdated
+            if (broken or not os.path.isfile(orig_path) or
+              src_mtime != thumb_mtime):
+                try:
+                    os.remove(entry_path)
                 except Exception:
-                    broken = True
-                # Thumb is orphaned or outdated
-                if (broken or not os.path.isfile(orig_path) or
-                  src_mtime != thumb_mtime):
-                    try:
-                        os.remove(entry_path)
-                    except Exception:
-                        continue
-                    removed_thumbs += 1
-                    size_thumbs += stats.st_size
-                    number_label.set_text('%d' % removed_thumbs)
-                    size_label.set_text('%.1f MiB' % (size_thumbs / 1048576.0))
-                    removing_label.set_text(_("Removed thumbnail for '%s'") %
-                        encoding.to_unicode(orig_path))
-                if iteration % 50 == 0:
-                    bar.set_fraction(iteration / self._total_thumbs)
-                while gtk.events_pending():
-                    gtk.main_iteration(False)
+                    continue
+                removed_thumbs += 1
+                size_thumbs += stats.st_size
+                number_label.set_text('%d' % removed_thumbs)
+                size_label.set_text('%.1f MiB' % (size_thumbs / 1048576.0))
+                removing_label.set_text(_("Removed thumbnail for '%s'") %
+                    encoding.to_unicode(orig_path))
+            if iteration % 50 == 0:
+                bar.set_fraction(iteration / self._total_thumbs)
+            while gtk.events_pending():
+                gtk.main_iteration(False)
 
         self._response()
 
@@ -206,6 +206,22 @@ class _ThumbnailRemover(gtk.Dialog):
         self.destroy()
 
 
+def _list_thumbnails():
+    """Return a list of tuples (path, is pack) for the stored thumbnails,
+    where the page thumbnail packs of archives are included (see
+    thumbpack.py).
+    """
+    thumbs = []
+    for subdir in ('normal', 'large'):
+        dir_path = os.path.join(_thumb_base, subdir)
+        if os.path.isdir(dir_path):
+            for entry in os.listdir(dir_path):
+                thumbs.append((os.path.join(dir_path, entry), False))
+    for pack_path in thumbpack.list_packs():
+        thumbs.append((pack_path, True))
+    return thumbs
+
+
 def _uri_to_path(uri):
     """Return the path corresponding to the URI <uri>, unless it is a
     non-local resource in which case we return the pathname with the type